@@ -21,5 +21,6 @@ setup(
     [console_scripts]
     api = zeit.api.application:run_local_api
     doc = zeit.api.application:run_local_doc
+    bench = zeit.api.benchmarks:main
     """,
     )
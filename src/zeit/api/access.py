@@ -8,11 +8,112 @@
     Copyright: (c) 2013 by ZEIT ONLINE.
     License: BSD, see LICENSE.md for more details.
 """
+import atexit
+import collections
+import os
+import sqlite3
+import threading
 import time
 
 from flask import g, current_app as current_app
 
-from . import exception
+from . import database, exception, metrics
+
+
+class Ledger(object):
+    """Per-process request counts, that are written to the database in
+    batches instead of once per request."""
+
+    def __init__(self):
+        self.database = None
+        self._pending = collections.defaultdict(int)
+        self._total = 0
+        self._flushed = time.time()
+        self._lock = threading.Lock()
+
+    def pending(self, api_key):
+        """Return the number of requests not yet written for a client."""
+        with self._lock:
+            return self._pending.get(api_key, 0)
+
+    def discard(self, api_key):
+        """Forget unwritten requests of a client, e.g. after a reset."""
+        with self._lock:
+            self._total -= self._pending.pop(api_key, 0)
+
+    def add(self, api_key):
+        """Count a request and return the client's unwritten requests."""
+        with self._lock:
+            self._pending[api_key] += 1
+            self._total += 1
+            return self._pending[api_key]
+
+    def due(self, max_requests, max_age):
+        """Tell whether enough requests or time have passed for a flush."""
+        with self._lock:
+            age = time.time() - self._flushed
+            return self._total >= max_requests or age >= max_age
+
+    def flush(self, db):
+        """Write all pending counts in a single transaction."""
+        with self._lock:
+            pending = self._pending.items()
+            self._pending.clear()
+            self._total = 0
+            self._flushed = time.time()
+        if len(pending) == 0:
+            return
+        query = ('UPDATE OR IGNORE client SET requests=requests + ? '
+            'WHERE api_key=?;')
+        try:
+            db.execute('BEGIN IMMEDIATE;')
+            db.executemany(query, ((n, key) for key, n in pending))
+            db.execute('COMMIT;')
+        except sqlite3.Error:
+            try:
+                db.execute('ROLLBACK;')
+            except sqlite3.Error:
+                pass
+            # Keep the counts, so the next flush can retry them.
+            with self._lock:
+                for key, n in pending:
+                    self._pending[key] += n
+                    self._total += n
+
+
+ledger = Ledger()
+
+_flusher_pid = None
+_flusher_lock = threading.Lock()
+
+
+def _flush_periodically(config):
+    """Flush the ledger in the configured interval, also without requests."""
+    db = database.connect(config)
+    while True:
+        time.sleep(config['ACCESS_FLUSH_INTERVAL'])
+        if ledger.due(config['ACCESS_FLUSH_REQUESTS'],
+                config['ACCESS_FLUSH_INTERVAL']):
+            ledger.flush(db)
+
+
+def _start_flusher(config):
+    """Start the ledger flusher of this process, unless it is running."""
+    global _flusher_pid
+    with _flusher_lock:
+        if _flusher_pid == os.getpid():
+            return
+        thread = threading.Thread(target=_flush_periodically, args=(config,))
+        thread.daemon = True
+        thread.start()
+        _flusher_pid = os.getpid()
+
+
+@atexit.register
+def _flush_ledger():
+    """Write remaining counts when a worker process shuts down."""
+    if ledger.database:
+        ledger.flush(sqlite3.connect(ledger.database, isolation_level=None))
 
 
 class Verifictaion(object):
@@ -20,6 +121,10 @@ class Verifictaion(object):
 
     def __enter__(self):
         """Verify key and quota. Raise exception if either fails."""
+        with metrics.span('quota'):
+            self._verify()
+
+    def _verify(self):
         if not hasattr(g, 'api_key'):
             raise exception.unauthorized()
 
@@ -29,7 +134,7 @@ class Verifictaion(object):
         if not client:
             raise exception.unauthorized()
 
-        requests = client[0]
+        requests = client[0] + ledger.pending(g.api_key)
         reset = client[1]
         quota = current_app.config['ACCESS_TIERS'][client[2]]
         timeframe = current_app.config['ACCESS_TIMEFRAME']
@@ -40,12 +145,38 @@ class Verifictaion(object):
             query = ('UPDATE OR IGNORE client SET reset=?, requests=? '
                 'WHERE api_key=?;')
             g.db.execute(query, (reset, requests, g.api_key))
+            ledger.discard(g.api_key)
 
         if quota <= requests:
             raise exception.too_many_requests()
 
+        self.headroom = quota - requests
+
     def __exit__(self, type, value, traceback):
-        """Increase request counter before closing context."""
-        query = ('UPDATE OR IGNORE client SET requests=requests + 1 '
-            'WHERE api_key=?;')
-        g.db.execute(query, (g.api_key,))
+        """Increase request counter before closing context.
+
+        In deferred mode, requests are only counted in memory and flushed
+        every ACCESS_FLUSH_REQUESTS requests or ACCESS_FLUSH_INTERVAL
+        seconds, by a background thread if no requests arrive. A client is
+        flushed right away, once its unwritten requests reach
+        ACCESS_MAX_OVERSHOOT or it gets that close to its quota.
+        """
+        with metrics.span('quota'):
+            self._count()
+
+    def _count(self):
+        config = current_app.config
+        if config['ACCESS_ACCOUNTING'] != 'deferred':
+            query = ('UPDATE OR IGNORE client SET requests=requests + 1 '
+                'WHERE api_key=?;')
+            g.db.execute(query, (g.api_key,))
+            return
+
+        ledger.database = config['DATABASE']
+        _start_flusher(config)
+        overshoot = config['ACCESS_MAX_OVERSHOOT']
+        pending = ledger.add(g.api_key)
+        if pending >= overshoot or self.headroom <= overshoot or ledger.due(
+                config['ACCESS_FLUSH_REQUESTS'],
+                config['ACCESS_FLUSH_INTERVAL']):
+            ledger.flush(g.db)
@@ -19,9 +19,9 @@ from . import settings, blueprints
 def make_app(blueprint, config):
     """Configure a flask instance with a given blueprint and configuration."""
     app = flask.Flask(import_name=__name__)
+    app.config.from_object(config)
     app.register_blueprint(blueprint)
     app.url_map.strict_slashes = False
-    app.config.from_object(config)
     return app
 
 
@@ -39,9 +39,9 @@ def run_local_doc():
     app.run(host=cfg.SERVERNAME, port=cfg.DOC_PORT, debug=True)
 
 
-def test_client_factory():
+def test_client_factory(config=settings.TestingConfig):
     """Return a client instance for automated testing."""
-    app = make_app(blueprints.api_server, settings.TestingConfig)
+    app = make_app(blueprints.api_server, config)
     return app.test_client()
 
 
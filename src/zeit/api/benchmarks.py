@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+"""
+    zeit.api.benchmarks
+    ~~~~~~~~~~~~~~~~~~~
+
+    This module contains benchmarks for the API server. The endpoint suite
+    runs against a local stand-in for Solr, that replays recorded responses,
+    and a SQLite fixture with realistic taxonomy sizes. It reports latency
+    percentiles and throughput, so regressions show up before deployment.
+
+        $ bin/bench                          # synthetic Solr responses
+        $ bin/bench --record http://localhost:8983/solr --recordings rec/
+        $ bin/bench --recordings rec/ --requests 500
+
+    Copyright: (c) 2013 by ZEIT ONLINE.
+    License: BSD, see LICENSE.md for more details.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import urllib
+import urlparse
+import zlib
+
+from . import application, database, settings, solr
+
+
+CONSTRUCTION = [
+    ('content search', "QueryFactory('content', q='title:merkel', "
+        "limit='100', fields='title,uuid', sort='release_date asc')"),
+    ('content facets', "QueryFactory('content', facet_field='keyword', "
+        "facet_date='1year')"),
+    ('keyword search', "QueryFactory('keyword', q='*merkel*', limit='10')"),
+    ('filtered search', "FilteredContentSearchQuery('keyword', 'merkel', "
+        "limit='10')"),
+    ('content by id', "ContentIdQuery('abc', fields='title,uuid')"),
+]
+
+# Row counts of the taxonomy tables in production, give or take.
+TAXONOMY = dict(author=20000, department=60, keyword=50000, product=40,
+    series=400)
+
+RECORDED = ('content/search', 'content/id')
+
+SURNAMES = ['Becker', 'Fischer', 'Hoffmann', 'Koch', 'Meyer', u'Müller',
+    'Richter', 'Schmidt', 'Schneider', 'Schulz', 'Wagner', 'Weber']
+GIVEN_NAMES = ['Anna', 'Felix', 'Jonas', 'Julia', 'Lea', 'Lukas', 'Marie',
+    'Paul', 'Sophie', 'Tim']
+WORDS = ['bildung', 'europa', 'finanzen', 'gesundheit', 'klima', 'kultur',
+    'merkel', 'politik', 'sport', 'technik', 'umwelt', 'wahl', 'wirtschaft',
+    'wissen']
+
+
+def construction(number=10000, repeat=3):
+    """Yield the cost of building each kind of query in microseconds."""
+    setup = ('from zeit.api.queries import QueryFactory, '
+        'FilteredContentSearchQuery, ContentIdQuery')
+    for name, statement in CONSTRUCTION:
+        timer = timeit.Timer(statement, setup)
+        yield name, min(timer.repeat(repeat, number)) / number * 1e6
+
+
+def taxonomy(seed=0):
+    """Yield table names and rows of a deterministic taxonomy fixture."""
+    rnd = random.Random(seed)
+    url = settings.TestingConfig.API_URL
+
+    def name(i):
+        return '%s %s %d' % (rnd.choice(GIVEN_NAMES), rnd.choice(SURNAMES), i)
+
+    def words(i):
+        return '%s %s %d' % (rnd.choice(WORDS), rnd.choice(WORDS), i)
+
+    rows = list()
+    for i in range(TAXONOMY['author']):
+        value = name(i)
+        rows.append(('', value.replace(' ', '-'), 'author',
+            '%s/author/%s' % (url, value.replace(' ', '-')), value))
+    yield 'author', rows
+
+    rows = list()
+    for i in range(TAXONOMY['department']):
+        dept_id = 'dept%d' % i
+        parent = 'dept%d' % (i % 10) if i >= 10 else ''
+        rows.append(('', dept_id, parent,
+            '%s/department/%s' % (url, dept_id), words(i)))
+    yield 'department', rows
+
+    rows = list()
+    types = ['subject', 'person', 'location', 'organization']
+    for i in range(TAXONOMY['keyword']):
+        value = words(i)
+        kw_id = value.replace(' ', '-')
+        rows.append(('', kw_id, value, rnd.randint(1, 100),
+            rnd.choice(types), '%s/keyword/%s' % (url, kw_id), value))
+    yield 'keyword', rows
+
+    rows = list()
+    for i in range(TAXONOMY['product']):
+        rows.append(('', 'prod%d' % i, '%s/product/prod%d' % (url, i),
+            words(i)))
+    yield 'product', rows
+
+    rows = list()
+    for i in range(TAXONOMY['series']):
+        rows.append(('', 'series%d' % i, words(i),
+            '%s/series/series%d' % (url, i), words(i)))
+    yield 'series', rows
+
+
+def synthetic(ids, number=1024, seed=0):
+    """Return Solr responses resembling recorded ones, for a fixture.
+
+    Documents refer to the given taxonomy ids, so enrichment finds them.
+    """
+    rnd = random.Random(seed)
+    docs = list()
+    for i in range(number):
+        uuid = '%08x-0000-4000-8000-%012x' % (rnd.getrandbits(32), i)
+        docs.append(dict(
+            uuid=uuid,
+            href='http://www.zeit.de/politik/2013-01/article-%d' % i,
+            title='Title of article %d' % i,
+            subtitle=' '.join(rnd.choice(WORDS) for w in range(30)),
+            supertitle=rnd.choice(WORDS).title(),
+            teaser_title='Teaser of article %d' % i,
+            teaser_text=' '.join(rnd.choice(WORDS) for w in range(25)),
+            release_date='2013-%02d-%02dT%02d:00:00Z' % (
+                rnd.randint(1, 12), rnd.randint(1, 28), rnd.randint(0, 23)),
+            author=[rnd.choice(ids['author']).replace('-', ' ')],
+            keyword=rnd.sample(ids['keyword'], 8),
+            department=rnd.choice(ids['department']),
+            sub_department=rnd.choice(ids['department']),
+            product=rnd.choice(ids['product']),
+            series=rnd.choice(ids['series']),
+            related=[]
+        ))
+    for doc in docs:
+        doc['related'] = [d['uuid'] for d in rnd.sample(docs, 3)]
+    search = dict(response=dict(numFound=len(docs), start=0, docs=docs),
+        highlighting=dict((d['uuid'], dict()) for d in docs))
+    single = dict(response=dict(numFound=1, start=0, docs=docs[:1]))
+    return {'content/search': search, 'content/id': single}
+
+
+class ReplayHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answer Solr requests with recorded responses."""
+
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one piece, small writes are delayed by Nagle.
+    wbufsize = -1
+
+    def log_message(self, *args):
+        pass
+
+    def _search(self, params):
+        recorded = self.server.recordings['content/search']['response']
+        docs = recorded['docs']
+        start = int(params.get('start', 0))
+        rows = int(params.get('rows', 10))
+        page = [docs[i % len(docs)] for i in range(start, start + rows)]
+        fields = params.get('fl', '').split(',')
+        if fields != ['']:
+            page = [dict((k, v) for k, v in doc.items() if k in fields)
+                for doc in page]
+        return dict(response=dict(numFound=recorded['numFound'],
+            start=start, docs=page),
+            highlighting=dict((d.get('uuid'), dict()) for d in page),
+            facet_counts=dict(facet_dates=dict(), facet_fields=dict()))
+
+    def _ids(self, params):
+        recorded = self.server.recordings['content/id']['response']['docs']
+        uuids = [u.strip('"()') for u in params.get('q', '').split(':', 1)[-1]
+            .replace('"', '').strip('()').split(' OR ')]
+        if params.get('fq', '').startswith('uuid:'):
+            uuids = [params['fq'][5:]]
+        docs = list()
+        for uuid in uuids:
+            doc = dict(recorded[len(docs) % len(recorded)])
+            doc['uuid'] = uuid
+            docs.append(doc)
+        return dict(response=dict(numFound=len(docs), start=0, docs=docs))
+
+    def do_GET(self):
+        parts = urlparse.urlsplit(self.path)
+        params = dict(urlparse.parse_qsl(parts.query))
+        action = parts.path.split('/', 2)[-1]
+        if action == 'content/search':
+            body = json.dumps(self._search(params))
+        elif action in ('content/id', 'content/ids'):
+            body = json.dumps(self._ids(params))
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            compressor = zlib.compressobj(6, zlib.DEFLATED,
+                16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ReplayServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A local stand-in for Solr, running in a background thread."""
+
+    daemon_threads = True
+
+    def __init__(self, recordings):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+            ReplayHandler)
+        self.recordings = recordings
+        self.url = 'http://127.0.0.1:%d/solr' % self.server_port
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def handle_error(self, request, client_address):
+        # Kept-alive connections are dropped when the benchmark exits.
+        pass
+
+
+def record(directory, solr_url):
+    """Store responses of a live Solr server for later replays."""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    queries = {'content/search': dict(q='*:*', rows=1024, wt='json'),
+        'content/id': dict(q='*:*', fq='*:*', rows=10, wt='json')}
+    for action in RECORDED:
+        url = '%s/%s?%s' % (solr_url.rstrip('/'), action,
+            urllib.urlencode(queries[action]))
+        with open(os.path.join(directory, action.replace('/', '-') +
+                '.json'), 'w') as f:
+            f.write(urllib.urlopen(url).read())
+
+
+def load(directory):
+    """Return recorded responses from a directory."""
+    recordings = dict()
+    for action in RECORDED:
+        path = os.path.join(directory, action.replace('/', '-') + '.json')
+        with open(path) as f:
+            recordings[action] = json.load(f)
+    return recordings
+
+
+def fixture(config):
+    """Fill the configured database with the taxonomy fixture.
+
+    Returns the ids of every table.
+    """
+    db = database.connect(config)
+    ids = dict()
+    db.execute('BEGIN;')
+    for table, rows in taxonomy():
+        query = 'INSERT INTO %s VALUES (%s);'
+        db.executemany(query % (table, ','.join('?' * len(rows[0]))), rows)
+        ids[table] = [row[1] for row in rows]
+    db.execute('COMMIT;')
+    if database.fulltext(config):
+        for table in database.FULLTEXT_TABLES:
+            database.rebuild_fulltext(db, table)
+    return ids
+
+
+def endpoints(ids, uuid):
+    """Yield names and URLs of all benchmarked endpoints."""
+    rnd = random.Random(1)
+    yield '/content', '/content'
+    yield '/content limit=100', '/content?limit=100'
+    yield '/content/<uuid>', '/content/%s' % uuid
+    yield '/content?ids=<50>', '/content?ids=%s' % ','.join(
+        '%032x' % i for i in range(50))
+    quote = lambda value: urllib.quote(value.encode('utf-8'))
+    for table in sorted(TAXONOMY):
+        yield '/%s/<id>' % table, '/%s/%s' % (table,
+            quote(rnd.choice(ids[table])))
+    for table in sorted(TAXONOMY):
+        yield '/%s?q=' % table, '/%s?q=%s*' % (table,
+            quote(rnd.choice(WORDS + SURNAMES)))
+    for table in sorted(TAXONOMY):
+        yield '/%s?q=*' % table, '/%s?q=*%s*' % (table,
+            quote(rnd.choice(WORDS + SURNAMES)[1:]))
+
+
+def percentile(timings, fraction):
+    """Return a percentile of sorted timings by the nearest rank method."""
+    rank = int(math.ceil(fraction * len(timings)))
+    return timings[min(max(rank, 1), len(timings)) - 1]
+
+
+def measure(client, url, headers, number=200, warmup=10):
+    """Request an URL repeatedly and return latency percentiles and rate."""
+    for i in range(warmup):
+        client.get(url, headers=headers)
+    timings = list()
+    started = time.time()
+    for i in range(number):
+        before = time.time()
+        response = client.get(url, headers=headers)
+        timings.append(time.time() - before)
+        if response.status_code != 200:
+            raise AssertionError('%s answered %d' % (url,
+                response.status_code))
+    elapsed = time.time() - started
+    timings.sort()
+    return dict(p50=percentile(timings, 0.5), p95=percentile(timings, 0.95),
+        p99=percentile(timings, 0.99), rps=number / elapsed)
+
+
+def suite(recordings=None, number=200, cached=False):
+    """Run all endpoint benchmarks and yield their names and results."""
+    directory = tempfile.mkdtemp()
+    try:
+        class BenchmarkConfig(settings.TestingConfig):
+            DATABASE = os.path.join(directory, 'benchmark.db')
+            ACCESS_TIERS = {'free': 10 ** 9}
+            CONTENT_CACHE_TTL = 60 if cached else 0
+
+        client = application.test_client_factory(BenchmarkConfig)
+        ids = fixture(client.application.config)
+        if recordings is None:
+            recordings = synthetic(ids)
+        server = ReplayServer(recordings)
+        client.application.config['SOLR_URL'] = server.url
+        data = dict(name='Benchmark', email='benchmark@zeit.de')
+        api_key = json.loads(client.post('/client', data=data).data)
+        headers = {'X-Authorization': api_key['api_key']}
+        uuid = recordings['content/id']['response']['docs'][0]['uuid']
+        for name, url in endpoints(ids, uuid):
+            yield name, measure(client, url, headers, number)
+        with client.application.app_context():
+            solr.balancer().close()
+        server.shutdown()
+        server.server_close()
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the API server against a Solr stand-in.')
+    parser.add_argument('--recordings', metavar='DIRECTORY',
+        help='recorded Solr responses, synthetic ones are used otherwise')
+    parser.add_argument('--record', metavar='SOLR_URL',
+        help='record responses of a Solr server to --recordings and exit')
+    parser.add_argument('--requests', type=int, default=200,
+        help='number of requests per endpoint')
+    parser.add_argument('--cached', action='store_true',
+        help='keep the response cache enabled')
+    parser.add_argument('--construction', action='store_true',
+        help='only measure the cost of building queries')
+    args = parser.parse_args()
+
+    if args.record:
+        if not args.recordings:
+            parser.error('--record requires --recordings')
+        record(args.recordings, args.record)
+        return
+    if args.construction:
+        for name, microseconds in construction():
+            print '%-20s %8.2f us' % (name, microseconds)
+        return
+
+    recordings = load(args.recordings) if args.recordings else None
+    print '%-24s %9s %9s %9s %9s' % ('endpoint', 'p50 ms', 'p95 ms',
+        'p99 ms', 'req/s')
+    for name, result in suite(recordings, args.requests, args.cached):
+        print '%-24s %9.2f %9.2f %9.2f %9.1f' % (name, result['p50'] * 1e3,
+            result['p95'] * 1e3, result['p99'] * 1e3, result['rps'])
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -9,14 +9,14 @@
     Copyright: (c) 2013 by ZEIT ONLINE.
     License: BSD, see LICENSE.md for more details.
 """
-import contextlib
-import sqlite3
+import hashlib
 
 import flask
 from flask import g, jsonify, current_app as current_app
 from werkzeug.datastructures import ImmutableDict
 
-from . import access, metadata, exception, queries
+from . import access, compression, database, exception, jobs, metrics
+from . import queries, util
 
 
 api_server = flask.Blueprint('api_server', __name__)
@@ -45,54 +45,107 @@ def handle_internal_server_error(error):
     return exception.internal_server_error(error)
 
 
-@api_server.before_app_first_request
-def initialize_database():
-    """On first startup, make sure the database is initialized."""
-    g.db = sqlite3.connect(current_app.config['DATABASE'],
-        isolation_level=None)
-    schema = (current_app.root_path + current_app.config['SCHEMA'])
-    with contextlib.closing(g.db) as db:
-        with api_server.open_resource(schema) as f:
-            db.cursor().executescript(f.read())
-            db.commit()
+@api_server.record_once
+def prepare_definition(state):
+    """Serialize the API definition, which depends on code and config only."""
+    with state.app.app_context():
+        definition = queries.DefinitionQuery().fetch()
+    body = flask.json.dumps(definition, indent=2)
+    compressed = compression.gzip(body, state.app.config['COMPRESSION_LEVEL'])
+    state.app.extensions['definition'] = (body, compressed,
+        hashlib.sha1(body).hexdigest())
 
 
 @api_server.before_app_request
 def before_request():
     """Intercept preflight requests, connect db and extract API key."""
+    metrics.start()
     if flask.request.method == 'OPTIONS':
         return flask.Response(status=204)
-    g.db = sqlite3.connect(current_app.config['DATABASE'],
-        isolation_level=None)
+    g.db = database.connect()
+    jobs.schedule()
     g.api_key = flask.request.headers.get('X-Authorization',
         flask.request.args.get('api_key', None))
 
 
 @api_server.after_app_request
 def after_request(response):
-    """Optionally convert to JSONP, set response headers and close db."""
+    """Optionally convert to JSONP, set response headers, compress and add
+    timings."""
     callback = flask.request.args.get('callback', False)
-    if callback:
+    if callback and not response.is_streamed and response.status_code != 304:
         response.data = str(callback) + '(' + response.data + ');'
         response.mimetype = 'application/javascript'
-    response.mimetype += ';charset=UTF-8'
+    if 'charset' not in response.headers.get('Content-Type', ''):
+        response.mimetype += ';charset=UTF-8'
     response.headers['Server'] = 'Zeit Api'
-    response.headers['Cache-Control'] = 'max-age=1'
-    if hasattr(g, 'db'):
-        g.db.close()
-    return response
+    response.headers.setdefault('Cache-Control', 'max-age=1')
+    with metrics.span('gzip'):
+        response = compression.compress(response)
+    return metrics.finish(response)
+
+
+def respond(document):
+    """Return a JSON response, that is encoded while it is sent if large.
+
+    Streamed responses never hold the whole encoded document in memory and
+    wrap JSONP callbacks around it as first and last chunk.
+    """
+    matches = document.get('matches', ())
+    if len(matches) < current_app.config['STREAM_MIN_MATCHES']:
+        with metrics.span('json'):
+            return jsonify(document)
+    indent = None if flask.request.is_xhr else 2
+    callback = flask.request.args.get('callback', False)
+    if callback:
+        prefix, suffix = str(callback) + '(', ');'
+        mimetype = 'application/javascript'
+    else:
+        prefix, suffix = '', ''
+        mimetype = 'application/json'
+    chunks = util.json_chunks(document, indent, prefix, suffix,
+        current_app.config['STREAM_CHUNK_SIZE'])
+    return flask.Response(chunks, mimetype=mimetype)
 
 
 @api_server.route('/')
 def show_definition():
-    query = queries.DefinitionQuery()
-    return jsonify(query.fetch())
+    body, compressed, etag = current_app.extensions['definition']
+    response = flask.Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    if compression.accepted() and 'callback' not in flask.request.args:
+        response.data = compressed
+        response.headers['Content-Encoding'] = 'gzip'
+        response.set_etag(etag + '-gzip')
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config['DEFINITION_MAX_AGE']
+    return response.make_conditional(flask.request)
 
 
 @api_server.route('/trigger')
 def trigger_update():
-    metadata.update()
-    return flask.Response(status=204)
+    job_id = jobs.start()
+    uri = '%s/trigger/%d' % (current_app.config['API_URL'], job_id)
+    response = jsonify(id=job_id, uri=uri)
+    response.status_code = 202
+    response.headers['Location'] = uri
+    return response
+
+
+@api_server.route('/trigger/<int:job_id>')
+def trigger_status(job_id):
+    job = jobs.status(job_id)
+    if job is None:
+        raise exception.resource_not_found('Job %d does not exist.' % job_id)
+    return jsonify(job)
+
+
+@api_server.route('/metrics')
+def show_metrics():
+    with access.Verifictaion():
+        return flask.Response(metrics.render(g.db),
+            mimetype='text/plain; version=0.0.4')
 
 
 @api_server.route('/client',  methods=['POST'])
@@ -107,7 +160,7 @@ def search(endpoint):
     with access.Verifictaion():
         param = flask.request.args.copy().to_dict()
         query = queries.QueryFactory(endpoint, **param)
-        return jsonify(query.fetch())
+        return respond(query.fetch())
 
 
 @api_server.route('/<string:endpoint>/<string:res>')
@@ -115,7 +168,17 @@ def filtered_search(endpoint, res):
     with access.Verifictaion():
         param = flask.request.args.copy().to_dict()
         query = queries.FilteredContentSearchQuery(endpoint, res, **param)
-        return jsonify(query.fetch())
+        return respond(query.fetch())
+
+
+@api_server.route('/content/export')
+def export_content():
+    with access.Verifictaion():
+        param = flask.request.args.copy().to_dict()
+        query = queries.ContentSearchQuery(**param)
+        lines = query.export()
+    return flask.Response(flask.stream_with_context(lines),
+        mimetype='application/x-ndjson')
 
 
 @api_server.route('/content/<string:uuid>')
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+    zeit.api.cache
+    ~~~~~~~~~~~~~~
+
+    This module contains per-process caches. Metadata rows are cached until
+    the generation counter in the database is bumped by a metadata update,
+    search results until they expire.
+
+    Copyright: (c) 2013 by ZEIT ONLINE.
+    License: BSD, see LICENSE.md for more details.
+"""
+
+import collections
+import json
+import threading
+import time
+
+from flask import g, current_app
+
+
+class LRUCache(object):
+    """A bounded, thread-safe mapping evicting the least recently used key."""
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.generation = None
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def validate(self, generation):
+        """Drop all entries, if they stem from a different generation."""
+        with self._lock:
+            if generation != self.generation:
+                self._data.clear()
+                self.generation = generation
+
+
+class ResponseCache(object):
+    """A memory bound cache of query results, that expire after a while.
+
+    The size of an entry is estimated by the length of its JSON encoding.
+    Hits and misses are counted for monitoring. Variants of an entry, like
+    its compressed encoding, are kept with the entry and expire with it.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _evict(self, weight):
+        while self._data and self.used + weight > self.size:
+            self.used -= self._data.popitem(last=False)[1][1]
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    self.used -= entry[1]
+                self.misses += 1
+                return None
+            self._data[key] = entry
+            self.hits += 1
+            return entry[2]
+
+    def set(self, key, value):
+        weight = len(json.dumps(value))
+        if weight > self.size:
+            return
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self.used -= entry[1]
+            self._evict(weight)
+            self._data[key] = [time.time() + self.ttl, weight, value, dict()]
+            self.used += weight
+
+    def get_variant(self, key, name):
+        """Return a variant of a live entry, or None if there is none."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.time():
+                return None
+            return entry[3].get(name)
+
+    def set_variant(self, key, name, value):
+        """Store a string derived from a live entry, e.g. its encoding."""
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    self.used -= entry[1]
+                return
+            self.used -= entry[1]
+            entry[1] += len(value) - len(entry[3].get(name, ''))
+            if entry[1] <= self.size:
+                entry[3][name] = value
+            else:
+                entry[1] -= len(value) - len(entry[3].get(name, ''))
+            self._evict(entry[1])
+            self._data[key] = entry
+            self.used += entry[1]
+
+    def fetch(self, key, loader):
+        """Return a cached result or compute it by calling the loader."""
+        if self.ttl <= 0:
+            return loader()
+        value = self.get(key)
+        if value is None:
+            value = loader()
+            self.set(key, value)
+        return value
+
+
+_missing = object()
+_taxonomy = None
+_responses = None
+
+
+def generation(db):
+    """Return the current generation of the metadata tables."""
+    return db.execute('SELECT value FROM generation;').fetchone()[0]
+
+
+def current_generation():
+    """Return the generation of the metadata tables for the current request.
+
+    It is read once per request, so cache hits do not touch the database.
+    """
+    if getattr(g, 'generation', None) is None:
+        g.generation = generation(g.db)
+    return g.generation
+
+
+def bump_generation(db):
+    """Invalidate cached metadata rows in all worker processes."""
+    db.execute('UPDATE generation SET value = value + 1;')
+
+
+def taxonomy():
+    """Return the metadata row cache of this process."""
+    global _taxonomy
+    if _taxonomy is None:
+        _taxonomy = LRUCache(current_app.config['TAXONOMY_CACHE_SIZE'])
+    return _taxonomy
+
+
+def responses():
+    """Return the search result cache of this process."""
+    global _responses
+    if _responses is None:
+        _responses = ResponseCache(current_app.config['CONTENT_CACHE_SIZE'],
+            current_app.config['CONTENT_CACHE_TTL'])
+    return _responses
+
+
+def lookup(key, ids, loader):
+    """Return metadata rows by id, reading missing ones through a loader.
+
+    Rows are cached as (key, id) pairs. The loader is called with a list of
+    uncached ids and returns a dictionary of rows by id. Unknown ids are
+    cached as well, so they do not hit the database again.
+    """
+    store = taxonomy()
+    store.validate(current_generation())
+    rows = dict()
+    missing = list()
+    for item in set(ids):
+        row = store.get((key, item), _missing)
+        if row is _missing:
+            missing.append(item)
+        elif row is not None:
+            rows[item] = row
+    if missing:
+        loaded = loader(missing)
+        for item in missing:
+            store.set((key, item), loaded.get(item))
+            if item in loaded:
+                rows[item] = loaded[item]
+    return rows
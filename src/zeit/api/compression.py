@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+    zeit.api.compression
+    ~~~~~~~~~~~~~~~~~~~~
+
+    This module compresses responses for clients accepting gzip. Responses
+    built from a cached query result keep their compressed body in the
+    response cache, so hot responses are compressed only once.
+
+    Copyright: (c) 2013 by ZEIT ONLINE.
+    License: BSD, see LICENSE.md for more details.
+"""
+
+import zlib
+
+from flask import g, current_app, request
+
+from . import cache
+
+
+def accepted():
+    """Tell whether the client of the current request accepts gzip."""
+    return request.accept_encodings['gzip'] > 0
+
+
+def _compressor(level):
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def gzip(data, level=6):
+    """Return the gzip compressed form of a string."""
+    compressor = _compressor(level)
+    return compressor.compress(data) + compressor.flush()
+
+
+def gzip_stream(chunks, level=6, store=None):
+    """Compress an iterable of strings chunk by chunk.
+
+    Once all chunks are compressed, the complete body is passed to store.
+    """
+    compressor = _compressor(level)
+    body = list()
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            body.append(compressed)
+            yield compressed
+    body.append(compressor.flush())
+    yield body[-1]
+    if store is not None:
+        store(''.join(body))
+
+
+def compress(response):
+    """Compress a successful response, if it is large enough.
+
+    If the response was built from a cached query result, its compressed
+    body is taken from or put into the response cache.
+    """
+    if response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+    response.vary.add('Accept-Encoding')
+    if not accepted():
+        return response
+
+    level = current_app.config['COMPRESSION_LEVEL']
+    key = getattr(g, 'response_key', None)
+    variant = ('gzip', level, request.args.get('callback'), request.is_xhr)
+    responses = cache.responses()
+    body = responses.get_variant(key, variant) if key else None
+
+    if body is not None:
+        response.data = body
+    elif response.is_streamed:
+        store = None
+        if key is not None:
+            store = lambda body: responses.set_variant(key, variant, body)
+        response.response = gzip_stream(response.response, level, store)
+    elif len(response.data) >= current_app.config['COMPRESSION_MIN_SIZE']:
+        response.data = gzip(response.data, level)
+        if key is not None:
+            responses.set_variant(key, variant, response.data)
+    else:
+        return response
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+    zeit.api.database
+    ~~~~~~~~~~~~~~~~~
+
+    This module manages connections to the API's SQLite database. Every
+    worker thread keeps one long-lived connection, so the page cache and
+    prepared statements survive between requests.
+
+    Copyright: (c) 2013 by ZEIT ONLINE.
+    License: BSD, see LICENSE.md for more details.
+"""
+
+import os
+import sqlite3
+import threading
+
+from flask import current_app
+
+
+# Metadata tables, that entity pages and enrichments may read by id.
+TAXONOMY_TABLES = frozenset(['author', 'department', 'keyword', 'product',
+    'series'])
+
+FULLTEXT_TABLES = ('author', 'department', 'keyword', 'product', 'series')
+
+_local = threading.local()
+_initialized = dict()
+_initialized_lock = threading.Lock()
+
+
+def _initialize_fulltext(db, config):
+    """Create full-text indexes, if SQLite supports them.
+
+    Indexes of an older schema are dropped and built again.
+    """
+    query = 'SELECT name, sql FROM sqlite_master WHERE name LIKE ?;'
+    existing = dict(db.execute(query, ('%_fts',)).fetchall())
+    for name, sql in existing.items():
+        if 'trigram' not in sql:
+            db.execute('DROP TABLE %s;' % name)
+            del existing[name]
+    schema = os.path.dirname(__file__) + config['SEARCH_SCHEMA']
+    try:
+        with open(schema) as f:
+            db.executescript(f.read())
+    except sqlite3.OperationalError:
+        return False
+    for table in FULLTEXT_TABLES:
+        if '%s_fts' % table not in existing:
+            rebuild_fulltext(db, table)
+    return True
+
+
+def initialize(db, config):
+    """Execute the schema scripts once per process and database file."""
+    with _initialized_lock:
+        key = (os.getpid(), config['DATABASE'])
+        if key in _initialized:
+            return
+        schema = os.path.dirname(__file__) + config['SCHEMA']
+        with open(schema) as f:
+            db.executescript(f.read())
+        _initialized[key] = _initialize_fulltext(db, config)
+
+
+def fulltext(config=None):
+    """Tell whether the metadata tables have full-text indexes."""
+    config = config or current_app.config
+    return _initialized.get((os.getpid(), config['DATABASE']), False)
+
+
+def rebuild_fulltext(db, table):
+    """Rebuild the full-text index of a metadata table from its content."""
+    query = "INSERT INTO %s_fts(%s_fts) VALUES ('rebuild');"
+    db.execute(query % (table, table))
+
+
+def connect(config=None):
+    """Return the connection of the current thread, opening it if needed.
+
+    Connections run in autocommit mode, use write-ahead logging, so readers
+    are not blocked by writes, and map the database file into memory.
+    """
+    config = config or current_app.config
+    if getattr(_local, 'pid', None) != os.getpid():
+        _local.connections = dict()
+        _local.pid = os.getpid()
+    path = config['DATABASE']
+    if path not in _local.connections:
+        db = sqlite3.connect(path, isolation_level=None,
+            cached_statements=config['DATABASE_STATEMENT_CACHE'])
+        db.execute('PRAGMA journal_mode=WAL;')
+        db.execute('PRAGMA synchronous=NORMAL;')
+        db.execute('PRAGMA mmap_size=%d;' % config['DATABASE_MMAP_SIZE'])
+        initialize(db, config)
+        _local.connections[path] = db
+    return _local.connections[path]
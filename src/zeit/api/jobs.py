@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+    zeit.api.jobs
+    ~~~~~~~~~~~~~
+
+    This module runs metadata updates as background jobs. Only one update
+    runs at a time across all worker processes, which is ensured by a lock
+    file next to the database. Progress and timings are kept in the job
+    table, so any process can report the status of a job.
+
+    Copyright: (c) 2013 by ZEIT ONLINE.
+    License: BSD, see LICENSE.md for more details.
+"""
+
+import fcntl
+import json
+import os
+import threading
+import time
+
+from flask import current_app
+
+from . import database, metadata
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def _acquire(config):
+    """Return the held update lock file, or None if it is taken."""
+    lock = open(config['DATABASE'] + '.lock', 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        lock.close()
+        return None
+    return lock
+
+
+def _run(app, job_id, lock):
+    """Update the metadata and record progress of the given job."""
+    db = database.connect(app.config)
+    timings = dict()
+
+    def report(source, seconds):
+        timings[source] = round(seconds, 3)
+        query = 'UPDATE job SET progress = ?, timings = ? WHERE id = ?;'
+        db.execute(query, (len(timings), json.dumps(timings), job_id))
+
+    try:
+        with app.app_context():
+            metadata.update(db, report)
+    except Exception, e:
+        app.logger.exception('Metadata update %d failed.' % job_id)
+        query = 'UPDATE job SET state = ?, finished = ?, error = ? ' \
+            'WHERE id = ?;'
+        db.execute(query, ('failed', time.time(), repr(e), job_id))
+    else:
+        query = 'UPDATE job SET state = ?, finished = ? WHERE id = ?;'
+        db.execute(query, ('done', time.time(), job_id))
+    finally:
+        lock.close()
+
+
+def start(app=None):
+    """Start a metadata update in a background thread and return its id.
+
+    If an update is already running, the id of that job is returned instead.
+    """
+    app = app or current_app._get_current_object()
+    db = database.connect(app.config)
+    db.execute('BEGIN IMMEDIATE;')
+    try:
+        lock = _acquire(app.config)
+        if lock is None:
+            job_id = db.execute('SELECT MAX(id) FROM job;').fetchone()[0]
+            db.execute('COMMIT;')
+            return job_id
+        # Nobody holds the lock, so running jobs were interrupted.
+        query = 'UPDATE job SET state = ?, error = ? WHERE state = ?;'
+        db.execute(query, ('failed', 'interrupted', 'running'))
+        query = 'INSERT INTO job (state, created, total) VALUES (?, ?, ?);'
+        job_id = db.execute(query, ('running', time.time(),
+            len(metadata.SOURCES))).lastrowid
+        db.execute('COMMIT;')
+    except:
+        db.execute('ROLLBACK;')
+        raise
+    thread = threading.Thread(target=_run, args=(app, job_id, lock))
+    thread.daemon = True
+    thread.start()
+    return job_id
+
+
+def status(job_id):
+    """Return the status of a job as a dictionary, or None if it is unknown."""
+    columns = ('id', 'state', 'created', 'finished', 'progress', 'total',
+        'timings', 'error')
+    query = 'SELECT %s FROM job WHERE id = ?;' % ','.join(columns)
+    row = database.connect().execute(query, (job_id,)).fetchone()
+    if row is None:
+        return None
+    job = dict(zip(columns, row))
+    job['timings'] = json.loads(job['timings'])
+    return job
+
+
+def _due(db, interval):
+    """Tell whether the last update was started longer than interval ago."""
+    created = db.execute('SELECT MAX(created) FROM job;').fetchone()[0]
+    return created is None or created + interval <= time.time()
+
+
+def _schedule(app, interval):
+    """Start metadata updates in the given interval, forever."""
+    db = database.connect(app.config)
+    while True:
+        time.sleep(min(interval, 60))
+        try:
+            if _due(db, interval):
+                start(app)
+        except Exception:
+            app.logger.exception('Scheduling a metadata update failed.')
+
+
+def schedule():
+    """Start the update scheduler of this process, if it is configured.
+
+    Every process runs a scheduler, but an update only starts if none was
+    started within the interval by any process.
+    """
+    global _scheduler
+    interval = current_app.config['METADATA_REFRESH_INTERVAL']
+    if not interval:
+        return
+    with _scheduler_lock:
+        if _scheduler is not None and _scheduler[0] == os.getpid():
+            return
+        app = current_app._get_current_object()
+        thread = threading.Thread(target=_schedule, args=(app, interval))
+        thread.daemon = True
+        thread.start()
+        _scheduler = (os.getpid(), thread)
@@ -10,106 +10,282 @@
     License: BSD, see LICENSE.md for more details.
 """
 
+import contextlib
+import functools
+import hashlib
+import httplib
+import multiprocessing.pool
+import socket
+import tempfile
+import time
 import urllib
+import urllib2
 
 from flask import g, current_app
 from lxml import etree
 
+from . import cache, database, solr
 from .util import iri_to_uri, save_xpath
 
 
-def __update_product(product):
-    """Update the given product entity."""
+def __parse_product(product):
+    """Return the row of the given product entity."""
     product_id = save_xpath(product, './@id').lower()
     uri = '%s/product/%s' % (current_app.config['API_URL'], product_id)
     value = save_xpath(product, 'text()')
     href = save_xpath(product, './@href')
-    query = 'REPLACE INTO product VALUES (?, ?, ?, ?);'
-    g.db.execute(query, (href, product_id, uri, value))
+    return (href, product_id, uri, value)
 
 
-def __update_series(series):
-    """Update the given series entity."""
+def __parse_series(series):
+    """Return the row of the given series entity."""
     series_id = save_xpath(series, './@url')
     uri = '%s/series/%s' % (current_app.config['API_URL'], series_id)
     value = save_xpath(series, './@title')
     name = save_xpath(series, './@serienname')
-    query = 'REPLACE INTO series VALUES (?, ?, ?, ?, ?);'
     href = 'http://www.zeit.de/serie/%s' % series_id
-    g.db.execute(query, (href, series_id, name, uri, value))
+    return (href, series_id, name, uri, value)
 
 
-def __update_keyword(keyword, ranks, types):
-    """Update the given keyword entity."""
+def __parse_keyword(keyword, scores, types):
+    """Return the row of the given keyword entity."""
     kw_id = save_xpath(keyword, './@url_value')
     uri = '%s/keyword/%s' % (current_app.config['API_URL'], kw_id)
     value = save_xpath(keyword, 'text()')
     lexical = save_xpath(keyword, './@lexical_value')
     kw_type = save_xpath(keyword, './@type')
     kw_type = 'subject' if kw_type in ['free', 'topic'] else kw_type.lower()
-    score = (ranks.index(int(save_xpath(keyword, './@freq'))) + 1)
-    score = int(100.0 / len(ranks) * score)
+    score = scores[int(save_xpath(keyword, './@freq'))]
     href = 'http://www.zeit.de/schlagworte/%s/%s/index' % (types[kw_type], kw_id)
-    query = 'REPLACE INTO keyword VALUES (?, ?, ?, ?, ?, ?, ?);'
-    g.db.execute(query, (href, kw_id, lexical, score, kw_type, uri, value))
+    return (href, kw_id, lexical, score, kw_type, uri, value)
 
 
-def __update_department(department):
-    """Update the given department entity."""
+def __parse_department(department):
+    """Return the row of the given department entity."""
     dept_id = save_xpath(department, './@label')
     if dept_id in ['startseite']:
-        return
+        return None
     uri = '%s/department/%s' % (current_app.config['API_URL'], dept_id)
     value = save_xpath(department, 'text()')
     href = save_xpath(department, './@href')[19:].split('/', 1)[0]
     parent = href if href != dept_id else ''
     path = parent + '/' + dept_id if parent else dept_id
     href = 'http://www.zeit.de/%s/index' % path
-    query = 'REPLACE INTO department VALUES (?, ?, ?, ?, ?);'
-    g.db.execute(query, (href, dept_id, parent, uri, value))
+    return (href, dept_id, parent, uri, value)
 
 
-def __update_author(author):
-    """Update the given author entity."""
+def __parse_author(author):
+    """Return the row of the given author entity."""
     value = save_xpath(author, './@name')
     author_id = value.replace(' ', '-')
     uri = '%s/author/%s' % (current_app.config['API_URL'], author_id)
     initial = value.split(' ')[-1] or 'A'
     href_raw = 'http://www.zeit.de/autoren/%s/%s/index.xml'
     href = href_raw % (initial[0], value.replace(' ', '_'))
-    href = href if urllib.urlopen(iri_to_uri(href)).getcode() == 200 else ''
-    query = 'REPLACE INTO author VALUES (?, ?, ?, ?, ?);'
-    g.db.execute(query, (href, author_id, 'author', uri, value))
+    return (href, author_id, 'author', uri, value)
 
 
-def update():
-    """Update metadata of all categories and write changes to database."""
-    products = current_app.config['PRODUCT_ALPHABET']
-    for p in etree.parse(products).xpath('//product'):
-        __update_product(p)
+def __probe(href, timeout):
+    """Return the HTTP status of the given URL, or None if it is unknown."""
+    request = urllib2.Request(iri_to_uri(href))
+    request.get_method = lambda: 'HEAD'
+    try:
+        return urllib2.urlopen(request, timeout=timeout).getcode()
+    except urllib2.HTTPError, e:
+        return e.code
+    except (urllib2.URLError, httplib.HTTPException, socket.error):
+        return None
 
-    series = current_app.config['SERIES_ALPHABET']
-    for s in etree.parse(series).xpath('//series'):
-        print s
-        __update_series(s)
 
-    keywords = current_app.config['KEYWORD_ALPHABET']
-    parsed_keywords = etree.parse(keywords).xpath('//tag')
-    ranks = sorted(set(int(save_xpath(k, './@freq')) for k in parsed_keywords))
+def __available(db, hrefs):
+    """Return the subset of URLs that exist, probing them concurrently.
+
+    Results are kept in the probe table and reused until they are older than
+    the configured recheck interval. URLs that could not be reached keep
+    their last known status and are probed again on the next update.
+    """
+    config = current_app.config
+    known = dict((row[0], row[1:]) for row in
+        db.execute('SELECT href, status, checked FROM probe;'))
+    outdated = time.time() - config['AUTHOR_PROBE_INTERVAL']
+    stale = [h for h in set(hrefs) if h not in known or
+        known[h][1] < outdated]
+
+    if stale:
+        probe = functools.partial(__probe,
+            timeout=config['AUTHOR_PROBE_TIMEOUT'])
+        pool = multiprocessing.pool.ThreadPool(config['AUTHOR_PROBE_THREADS'])
+        try:
+            results = pool.map(probe, stale, chunksize=1)
+        finally:
+            pool.close()
+        now = time.time()
+        probed = [(h, s, now) for h, s in zip(stale, results) if s is not None]
+        db.execute('BEGIN IMMEDIATE;')
+        try:
+            query = 'REPLACE INTO probe VALUES (?, ?, ?);'
+            db.executemany(query, probed)
+            db.execute('COMMIT;')
+        except:
+            db.execute('ROLLBACK;')
+            raise
+        known.update((h, (s, c)) for h, s, c in probed)
+
+    return set(h for h in hrefs if h in known and known[h][0] == 200)
+
+
+def __download(location):
+    """Return a local copy of the file or URL at the given location and its
+    checksum.
+
+    The checksum is computed while the copy is written, so a source is only
+    read once, both to detect changes and to be parsed.
+    """
+    digest = hashlib.sha1()
+    copy = tempfile.TemporaryFile()
+    with contextlib.closing(urllib.urlopen(location)) as f:
+        for chunk in iter(lambda: f.read(65536), ''):
+            digest.update(chunk)
+            copy.write(chunk)
+    return copy, digest.hexdigest()
+
+
+def __unchanged(db, source, fingerprint):
+    """Tell whether a source was already imported in this version."""
+    query = 'SELECT fingerprint FROM source WHERE name = ?;'
+    row = db.execute(query, (source,)).fetchone()
+    return row is not None and row[0] == fingerprint
+
+
+def __synchronize(db, table, rows, source=None, fingerprint=None):
+    """Write the difference between the given rows and a table.
+
+    All inserts, updates and deletes, the full-text index, the source's
+    fingerprint and the bumped cache generation are written in a single
+    transaction, so cached rows never outlive a change. Returns whether the
+    table was changed.
+    """
+    cursor = db.execute('SELECT * FROM %s;' % table)
+    columns = [column[0] for column in cursor.description]
+    existing = dict((row[1], row) for row in cursor)
+    incoming = dict((row[1], row) for row in rows if row is not None)
+    if len(incoming) == 0:
+        # An empty source is more likely broken than intended.
+        return False
+
+    inserts = [r for i, r in incoming.iteritems() if i not in existing]
+    updates = [r[:1] + r[2:] + r[1:2] for i, r in incoming.iteritems()
+        if i in existing and tuple(existing[i]) != tuple(r)]
+    deletes = [(i,) for i in existing if i not in incoming]
+
+    db.execute('BEGIN IMMEDIATE;')
+    try:
+        if inserts or updates or deletes:
+            query = 'INSERT INTO %s VALUES (%s);'
+            db.executemany(query % (table, ','.join('?' * len(columns))),
+                inserts)
+            query = 'UPDATE %s SET %s WHERE id = ?;'
+            assignments = ','.join('%s = ?' % c for c in columns if c != 'id')
+            db.executemany(query % (table, assignments), updates)
+            query = 'DELETE FROM %s WHERE id = ?;'
+            db.executemany(query % table, deletes)
+            if database.fulltext():
+                database.rebuild_fulltext(db, table)
+            cache.bump_generation(db)
+        if source is not None:
+            query = 'REPLACE INTO source VALUES (?, ?);'
+            db.execute(query, (source, fingerprint))
+        db.execute('COMMIT;')
+    except:
+        db.execute('ROLLBACK;')
+        raise
+    return bool(inserts or updates or deletes)
+
+
+def __iterparse(source, tag):
+    """Yield all elements with the given tag of an XML file one by one.
+
+    Elements are cleared once they are processed and removed from their
+    parent, so memory use does not grow with the size of the file.
+    """
+    source.seek(0)
+    for _, element in etree.iterparse(source, tag=tag):
+        yield element
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+
+def __update_alphabet(db, table, source, parse):
+    """Synchronize a table with an alphabet file, unless it is unchanged."""
+    copy, fingerprint = __download(current_app.config[source])
+    with copy:
+        if __unchanged(db, source, fingerprint):
+            return False
+        rows = parse(copy)
+        return __synchronize(db, table, rows, source, fingerprint)
+
+
+def __products(source):
+    return (__parse_product(p) for p in __iterparse(source, 'product'))
+
+
+def __series(source):
+    return (__parse_series(s) for s in __iterparse(source, 'series'))
+
+
+def __keywords(source):
+    freqs = set(int(save_xpath(k, './@freq'))
+        for k in __iterparse(source, 'tag'))
+    scores = dict((f, int(100.0 / len(freqs) * (i + 1)))
+        for i, f in enumerate(sorted(freqs)))
     types = {'location': 'orte', 'person': 'personen', 'subject': 'themen',
         'organization': 'organisationen'}
-    for k in parsed_keywords:
-        print k
-        __update_keyword(k, ranks, types)
-
-    depts = current_app.config['DEPARTMENT_ALPHABET']
-    for d in etree.parse(depts).xpath('/lists/list[@id="sitemap"]//link'):
-        print d
-        __update_department(d)
-
-    url = '/select?q=*:*&facet=true&facet.field=author'
-    url += '&facet.limit=1000000&rows=0&facet.mincount=1'
-    authors = current_app.config['SOLR_URL'] + url
-    for a in etree.parse(authors).xpath('//lst[@name="author"]/int'):
-        print a
-        __update_author(a)
+    return (__parse_keyword(k, scores, types)
+        for k in __iterparse(source, 'tag'))
+
+
+def __departments(source):
+    return (__parse_department(d) for d in __iterparse(source, 'link')
+        if d.xpath('ancestor::list[@id="sitemap"][parent::lists]'))
+
+
+def __update_authors(db):
+    """Synchronize the author table with the author facet of Solr."""
+    params = {'q': '*:*', 'facet': 'true', 'facet.field': 'author',
+        'facet.limit': 1000000, 'rows': 0, 'facet.mincount': 1}
+    authors = etree.fromstring(solr.fetch_raw('select', params,
+        background=True))
+    rows = [__parse_author(a) for a in
+        authors.xpath('//lst[@name="author"]/int')]
+    available = __available(db, [r[0] for r in rows])
+    rows = [(r[0] if r[0] in available else '',) + r[1:] for r in rows]
+    return __synchronize(db, 'author', rows)
+
+
+SOURCES = ('product', 'series', 'keyword', 'department', 'author')
+
+
+def update(db=None, report=None):
+    """Update metadata of all categories and write changes to database.
+
+    If given, report is called with the name of each source and the seconds
+    it took, once the source is done.
+    """
+    db = db or g.db
+    steps = {
+        'product': lambda: __update_alphabet(db, 'product',
+            'PRODUCT_ALPHABET', __products),
+        'series': lambda: __update_alphabet(db, 'series',
+            'SERIES_ALPHABET', __series),
+        'keyword': lambda: __update_alphabet(db, 'keyword',
+            'KEYWORD_ALPHABET', __keywords),
+        'department': lambda: __update_alphabet(db, 'department',
+            'DEPARTMENT_ALPHABET', __departments),
+        'author': lambda: __update_authors(db)
+    }
+    for source in SOURCES:
+        started = time.time()
+        steps[source]()
+        if report is not None:
+            report(source, time.time() - started)
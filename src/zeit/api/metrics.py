@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+"""
+    zeit.api.metrics
+    ~~~~~~~~~~~~~~~~
+
+    This module measures where requests spend their time. Spans around Solr
+    requests, SQLite statements and serialization are summed up per request
+    and sent as Server-Timing header. Every process also keeps histograms
+    per endpoint and publishes them to the database, where they are summed
+    up over all processes and exported in the Prometheus text format.
+
+    Copyright: (c) 2013 by ZEIT ONLINE.
+    License: BSD, see LICENSE.md for more details.
+"""
+
+import atexit
+import bisect
+import collections
+import contextlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from flask import g, current_app, has_request_context, request
+
+from . import cache, database
+
+
+class Timings(object):
+    """Summed up durations of named spans within one request.
+
+    Enrichment threads add to the timings of the request they work for.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self._spans = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            self._spans[name] = self._spans.get(name, 0.0) + seconds
+
+    def items(self):
+        with self._lock:
+            return self._spans.items()
+
+
+class Histogram(object):
+    """A cumulative histogram of observed values."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """Yield upper bounds and the number of values up to each."""
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            yield bound, total
+
+
+class Registry(object):
+    """Histograms of one process, by metric name and labels."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._histograms = dict()
+        self._lock = threading.Lock()
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram(self.buckets)
+            self._histograms[key].observe(value)
+
+    def snapshot(self):
+        """Return all histograms as a list, that can be stored as JSON."""
+        with self._lock:
+            return [[key[0], key[1], histogram.counts, histogram.sum]
+                for key, histogram in self._histograms.items()]
+
+    def merge(self, snapshot):
+        """Add the histograms of a snapshot to these."""
+        with self._lock:
+            for name, labels, counts, total in snapshot:
+                key = (name, tuple(tuple(label) for label in labels))
+                if key not in self._histograms:
+                    self._histograms[key] = Histogram(self.buckets)
+                histogram = self._histograms[key]
+                histogram.counts = [a + b for a, b in
+                    zip(histogram.counts, counts)]
+                histogram.count += sum(counts)
+                histogram.sum += total
+
+    def render(self, descriptions):
+        """Return all histograms in the Prometheus text format."""
+        lines = list()
+        with self._lock:
+            keys = sorted(self._histograms)
+            for name in sorted(set(key[0] for key in keys)):
+                lines.append('# HELP %s %s' % (name, descriptions[name]))
+                lines.append('# TYPE %s histogram' % name)
+                for key in (k for k in keys if k[0] == name):
+                    histogram = self._histograms[key]
+                    labels = ','.join('%s="%s"' % (l, _escape(v))
+                        for l, v in key[1])
+                    for bound, count in histogram.cumulative():
+                        lines.append('%s_bucket{%s,le="%s"} %d' % (name,
+                            labels, bound, count))
+                    lines.append('%s_sum{%s} %r' % (name, labels,
+                        histogram.sum))
+                    lines.append('%s_count{%s} %d' % (name, labels,
+                        histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+DESCRIPTIONS = {
+    'zeit_api_request_duration_seconds': 'Time spent answering requests.',
+    'zeit_api_span_duration_seconds': 'Time spent per request in Solr, '
+        'SQLite, quota accounting, serialization and compression.'
+}
+
+ENDPOINTS = frozenset(['author', 'client', 'content', 'department',
+    'keyword', 'product', 'series'])
+
+_registry = None
+_registry_pid = None
+_registry_lock = threading.Lock()
+_process = None
+_app = None
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n',
+        '\\n')
+
+
+def registry():
+    """Return the histograms of this process.
+
+    The first call of a process starts a thread, which publishes them every
+    METRICS_PUBLISH_INTERVAL seconds.
+    """
+    global _registry, _registry_pid, _process, _app
+    with _registry_lock:
+        if _registry_pid != os.getpid():
+            _registry = Registry(current_app.config['METRICS_BUCKETS'])
+            _registry_pid = os.getpid()
+            _process = '%d:%d' % (os.getpid(), time.time() * 1000)
+            _app = current_app._get_current_object()
+            thread = threading.Thread(target=_publish_periodically,
+                args=(_app,))
+            thread.daemon = True
+            thread.start()
+        return _registry
+
+
+def _snapshot():
+    """Return the metrics of this process as JSON."""
+    responses = cache.responses()
+    return json.dumps(dict(histograms=registry().snapshot(),
+        cache=[responses.hits, responses.misses, responses.used]))
+
+
+def _merge(snapshots):
+    """Return the summed up histograms and cache counters of snapshots."""
+    histograms = Registry(current_app.config['METRICS_BUCKETS'])
+    counters = [0, 0, 0]
+    for snapshot in snapshots:
+        snapshot = json.loads(snapshot)
+        histograms.merge(snapshot['histograms'])
+        counters = [a + b for a, b in zip(counters, snapshot['cache'])]
+    return histograms, counters
+
+
+def publish(db):
+    """Write the metrics of this process, so any process can export them."""
+    db.execute('REPLACE INTO metric VALUES (?, ?);', (_process, _snapshot()))
+
+
+def retire(db):
+    """Fold the metrics of this process into those of ended processes.
+
+    Counters of ended processes are kept, so sums over all processes never
+    go down, and their rows do not pile up.
+    """
+    db.execute('BEGIN IMMEDIATE;')
+    try:
+        row = db.execute('SELECT snapshot FROM metric WHERE process = ?;',
+            ('retired',)).fetchone()
+        histograms, counters = _merge(([row[0]] if row else []) +
+            [_snapshot()])
+        # Ended processes do not hold any cached responses.
+        snapshot = dict(histograms=histograms.snapshot(),
+            cache=counters[:2] + [0])
+        db.execute('REPLACE INTO metric VALUES (?, ?);', ('retired',
+            json.dumps(snapshot)))
+        db.execute('DELETE FROM metric WHERE process = ?;', (_process,))
+        db.execute('COMMIT;')
+    except:
+        db.execute('ROLLBACK;')
+        raise
+
+
+def _publish_periodically(app):
+    """Publish the metrics of this process in the configured interval."""
+    with app.app_context():
+        db = database.connect()
+        while True:
+            time.sleep(app.config['METRICS_PUBLISH_INTERVAL'])
+            try:
+                publish(db)
+            except sqlite3.Error:
+                app.logger.exception('Publishing metrics failed.')
+
+
+@atexit.register
+def _retire():
+    """Fold the metrics of an ending process into those of ended ones."""
+    if _app is None or _registry_pid != os.getpid():
+        return
+    with _app.app_context():
+        try:
+            retire(database.connect())
+        except sqlite3.Error:
+            pass
+
+
+def start():
+    """Start measuring the current request."""
+    g.timings = Timings()
+
+
+@contextlib.contextmanager
+def span(name):
+    """Add the duration of a block to a span of the current request."""
+    started = time.time()
+    try:
+        yield
+    finally:
+        timings = getattr(g, 'timings', None) if has_request_context() \
+            else None
+        if timings is not None:
+            timings.add(name, time.time() - started)
+
+
+def endpoint():
+    """Return the route of the current request as metric label.
+
+    Only known endpoints get a label of their own, so requests to arbitrary
+    paths can not add new series.
+    """
+    if request.url_rule is None:
+        return 'unknown'
+    rule = request.url_rule.rule
+    args = request.view_args or dict()
+    if 'endpoint' in args:
+        if args['endpoint'] not in ENDPOINTS:
+            return 'unknown'
+        rule = rule.replace('<string:endpoint>', args['endpoint'])
+    return re.sub(r'<(?:\w+:)?(\w+)>', r'{\1}', rule)
+
+
+def finish(response):
+    """Add a Server-Timing header and record the request's histograms."""
+    timings = getattr(g, 'timings', None)
+    if timings is None:
+        return response
+    total = time.time() - timings.started
+    spans = timings.items()
+    if current_app.config['METRICS_SERVER_TIMING']:
+        response.headers['Server-Timing'] = ', '.join('%s;dur=%.3f' % (
+            name, seconds * 1000) for name, seconds in spans + [('total',
+            total)])
+    # Unknown endpoints would add a label for every typo.
+    label = endpoint() if response.status_code != 404 else 'unknown'
+    histograms = registry()
+    histograms.observe('zeit_api_request_duration_seconds',
+        dict(endpoint=label), total)
+    for name, seconds in spans:
+        histograms.observe('zeit_api_span_duration_seconds',
+            dict(endpoint=label, span=name), seconds)
+    return response
+
+
+def render(db):
+    """Return the metrics of all processes in the Prometheus text format.
+
+    Other processes publish theirs every METRICS_PUBLISH_INTERVAL seconds.
+    """
+    publish(db)
+    histograms, counters = _merge(row[0] for row in
+        db.execute('SELECT snapshot FROM metric;'))
+    text = histograms.render(DESCRIPTIONS)
+    lines = [
+        '# HELP zeit_api_response_cache_hits_total Response cache hits.',
+        '# TYPE zeit_api_response_cache_hits_total counter',
+        'zeit_api_response_cache_hits_total %d' % counters[0],
+        '# HELP zeit_api_response_cache_misses_total Response cache misses.',
+        '# TYPE zeit_api_response_cache_misses_total counter',
+        'zeit_api_response_cache_misses_total %d' % counters[1],
+        '# HELP zeit_api_response_cache_bytes Size of the response cache.',
+        '# TYPE zeit_api_response_cache_bytes gauge',
+        'zeit_api_response_cache_bytes %d' % counters[2]
+    ]
+    return text + '\n'.join(lines) + '\n'
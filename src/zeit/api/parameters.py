@@ -11,24 +11,35 @@
     License: BSD, see LICENSE.md for more details.
 """
 
+import base64
+import json
 import re
 
 from . import exception, util
 
 
 class Param(object):
-    """The base class for all URL parameters."""
+    """The base class for all URL parameters.
+
+    Instances only hold the value of a request. Everything else is a class
+    attribute, use specialize to derive a parameter with other defaults.
+    """
+
+    __slots__ = ('_value',)
 
     key = None
     default = None
     origin = None
 
-    def __init__(self, **kwargs):
-        vkeys = list(k for k in kwargs.keys())
-        vargs = dict((k, v) for k, v in kwargs.iteritems() if k in vkeys)
-        self.__dict__.update(vargs)
+    def __init__(self):
         self._value = None
 
+    @classmethod
+    def specialize(cls, **attrs):
+        """Return a subclass with the given key, origin, default etc."""
+        attrs['__slots__'] = ()
+        return type(cls.__name__, (cls,), attrs)
+
     @property
     def value(self):
         return self._value or self.default
@@ -51,10 +62,9 @@ class Param(object):
 class StrParam(Param):
     """The base class for string parameters."""
 
-    default = ''
+    __slots__ = ()
 
-    def __init__(self, **kwargs):
-        super(StrParam, self).__init__(**kwargs)
+    default = ''
 
     def valid(self, value):
         super(StrParam, self).valid(value)
@@ -64,12 +74,11 @@ class StrParam(Param):
 class SqlQParam(StrParam):
     """A parameter class enforcing SQL syntax."""
 
+    __slots__ = ()
+
     default = '%'
     key = 'q'
 
-    def __init__(self, **kwargs):
-        super(SqlQParam, self).__init__(**kwargs)
-
     def valid(self, value):
         super(SqlQParam, self).valid(value)
         assert len(value) < 1024
@@ -90,36 +99,35 @@ class SqlQParam(StrParam):
 class FacetFieldParam(StrParam):
     """A parameter class for field facetting."""
 
+    __slots__ = ()
+
     default = ''
     origin = 'facet.field'
     key = 'facet_field'
 
-    def __init__(self, **kwargs):
-        super(FacetFieldParam, self).__init__(**kwargs)
+    whitelist = frozenset([
+        'department',
+        'product',
+        'sub_department',
+        'keyword',
+        'author',
+        'series'
+    ])
 
     def valid(self, value):
         super(FacetFieldParam, self).valid(value)
-        whitelist = [
-            'department',
-            'product',
-            'sub_department',
-            'keyword',
-            'author',
-            'series'
-        ]
-        assert value in whitelist
+        assert value in self.whitelist
 
 
 class FacetDateParam(StrParam):
     """A parameter class for date facetting."""
 
+    __slots__ = ()
+
     default = ''
     origin = 'facet.date.gap'
     key = 'facet_date'
 
-    def __init__(self, **kwargs):
-        super(FacetDateParam, self).__init__(**kwargs)
-
     def valid(self, value):
         super(FacetDateParam, self).valid(value)
         assert(re.match(r"^[0-9]{1,3}(day|month|year)$", value))
@@ -140,10 +148,9 @@ class FacetDateParam(StrParam):
 class IntParam(Param):
     """The base class for integer parameters."""
 
-    default = '0'
+    __slots__ = ()
 
-    def __init__(self, **kwargs):
-        super(IntParam, self).__init__(**kwargs)
+    default = '0'
 
     def __radd__(self, other):
         result = IntParam()
@@ -158,13 +165,12 @@ class IntParam(Param):
 class LimitParam(IntParam):
     """A class for limit parameters."""
 
+    __slots__ = ()
+
     default = '10'
     origin = 'rows'
     key = 'limit'
 
-    def __init__(self, **kwargs):
-        super(LimitParam, self).__init__(**kwargs)
-
     def valid(self, value):
         super(LimitParam, self).valid(value)
         assert int(value) >= 0 and int(value) <= 1024
@@ -173,43 +179,108 @@ class LimitParam(IntParam):
 class OffsetParam(IntParam):
     """A class for offset parameters."""
 
+    __slots__ = ()
+
     default = '0'
     origin = 'start'
     key = 'offset'
 
-    def __init__(self, **kwargs):
-        super(OffsetParam, self).__init__(**kwargs)
-
     def valid(self, value):
         super(OffsetParam, self).valid(value)
 
 
+class CursorParam(StrParam):
+    """A class for opaque pagination cursors.
+
+    A cursor encodes sort field, direction and the sort values of the last
+    document on the previous page. The first page is requested with '*'.
+    The sort value is null, if that document has none.
+    """
+
+    __slots__ = ()
+
+    key = 'cursor'
+    start = '*'
+
+    def valid(self, value):
+        super(CursorParam, self).valid(value)
+        assert value == self.start or self.decode(value) is not None
+
+    @staticmethod
+    def encode(position):
+        return base64.urlsafe_b64encode(json.dumps(position)).rstrip('=')
+
+    @staticmethod
+    def decode(value):
+        try:
+            padded = str(value) + '=' * (-len(value) % 4)
+            position = json.loads(base64.urlsafe_b64decode(padded))
+        except (TypeError, ValueError, UnicodeError):
+            return None
+        if not isinstance(position, list) or len(position) != 4:
+            return None
+        values = [v for i, v in enumerate(position) if i != 2 or v is not None]
+        if not all(isinstance(v, basestring) for v in values):
+            return None
+        return position
+
+
 class CsvParam(StrParam):
-    """The base class for comma seperated values."""
+    """The base class for comma seperated values.
+
+    The default lists all allowed values, columns maps each of them to its
+    position in the default.
+    """
+
+    __slots__ = ()
+
+    columns = dict()
 
-    def __init__(self, **kwargs):
-        super(CsvParam, self).__init__(**kwargs)
+    @classmethod
+    def specialize(cls, **attrs):
+        if 'default' in attrs:
+            attrs['columns'] = dict((c, i) for i, c in
+                enumerate(attrs['default'].split(',')))
+        return super(CsvParam, cls).specialize(**attrs)
 
     def __iter__(self):
         for item in self.value.split(','):
-            if item != '' and item in self.default.split(','):
+            if item != '' and item in self.columns:
                 yield item
 
     def valid(self, value):
         super(CsvParam, self).valid(value)
-        assert all(item in self.default.split(',') for item in self)
+        assert all(item in self.columns for item in self)
+
+
+class IdsParam(StrParam):
+    """A class for lists of content ids."""
+
+    __slots__ = ()
+
+    key = 'ids'
+
+    def __iter__(self):
+        seen = set()
+        for item in util.csv_to_list(self.value):
+            if item not in seen:
+                seen.add(item)
+                yield item
+
+    def valid(self, value):
+        super(IdsParam, self).valid(value)
+        assert 0 < len(list(util.csv_to_list(value))) <= 1024
 
 
 class FieldsParam(CsvParam):
     """A class for parial selection parameters."""
 
+    __slots__ = ()
+
     key = 'fields'
     origin = 'fl'
     enforce = ''
 
-    def __init__(self, **kwargs):
-        super(FieldsParam, self).__init__(**kwargs)
-
     def valid(self, value):
         super(FieldsParam, self).valid(value)
 
@@ -229,3 +300,27 @@ class FieldsParam(CsvParam):
             self._value = value if '*' not in value else self.default
         except AssertionError:
             raise exception.JSONBadRequest()
+
+
+class Spec(object):
+    """The compiled parameters of a query class.
+
+    Holds the parameter class of each attribute and their names in the URL
+    and in Solr, so queries do not need to find out on every request.
+    """
+
+    def __init__(self, **params):
+        self.params = tuple(sorted(params.items()))
+        self.names = frozenset(params)
+        self.keys = tuple((n, p.key) for n, p in self.params if p.key)
+        self.origins = tuple((n, p.origin or p.key) for n, p in self.params)
+
+    def extend(self, **params):
+        """Return a spec with additional or replaced parameters."""
+        merged = dict(self.params)
+        merged.update(params)
+        return Spec(**merged)
+
+    def make(self):
+        """Return a fresh parameter instance for every attribute."""
+        return dict((n, p()) for n, p in self.params)
@@ -12,21 +12,140 @@
     License: BSD, see LICENSE.md for more details.
 """
 
+import Queue
 import json
 import exceptions
 import os
+import re
+import sys
+import threading
 import time
 import urllib
-import urllib2
 import warnings
 
 from flask import g, current_app as current_app, request
 
-from . import exception, parameters, util
+from . import access, cache, database, exception, metrics, parameters, solr
+from . import util
+
+
+_idle = list()
+_workers = 0
+_workers_pid = None
+_workers_lock = threading.Condition()
+
+
+class _Worker(threading.Thread):
+    """A thread running enrichment steps, which waits idle in between.
+
+    Workers idle for a minute end, so a burst of requests does not leave
+    threads behind.
+    """
+
+    def __init__(self):
+        super(_Worker, self).__init__()
+        self.daemon = True
+        self.tasks = Queue.Queue()
+
+    def run(self):
+        global _workers
+        while True:
+            try:
+                task = self.tasks.get(timeout=60)
+            except Queue.Empty:
+                with _workers_lock:
+                    if self in _idle:
+                        _idle.remove(self)
+                        _workers -= 1
+                        return
+                # Another thread took this worker and is handing a task.
+                continue
+            task()
+            with _workers_lock:
+                _idle.append(self)
+                _workers_lock.notify()
+
+
+def _submit(task, deadline):
+    """Run a task in an idle worker, or in a new one if none is idle.
+
+    At most CONTENT_ENRICHMENT_THREADS workers run per process. If all are
+    busy until the deadline, the task is not run and False is returned.
+    """
+    global _workers, _workers_pid
+    limit = current_app.config['CONTENT_ENRICHMENT_THREADS']
+    with _workers_lock:
+        if _workers_pid != os.getpid():
+            del _idle[:]
+            _workers, _workers_pid = 0, os.getpid()
+        while not _idle and _workers >= limit:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            _workers_lock.wait(remaining)
+        if _idle:
+            worker = _idle.pop()
+        else:
+            worker = _Worker()
+            worker.start()
+            _workers += 1
+    worker.tasks.put(task)
+    return True
+
+
+def _in_context(app, environ, shared, function, argument):
+    """Call a function within a copy of the given request's context.
+
+    Shared attributes of the request's globals are copied into the copy.
+    """
+    with app.request_context(environ):
+        g.db = database.connect()
+        for name, value in shared.items():
+            setattr(g, name, value)
+        return function(argument)
+
+
+def _select(table, ids):
+    """Fetch all rows of a metadata table matching the given ids."""
+    ids = list(set(ids))
+    rows = dict()
+    # Stay well below SQLite's limit of host parameters per statement.
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        query = 'SELECT * FROM %s WHERE id IN (%s);' % (table,
+            ','.join('?' * len(chunk)))
+        with metrics.span('sqlite'):
+            cursor = g.db.execute(query, chunk)
+            names = [column[0] for column in cursor.description]
+            for row in cursor:
+                match = dict(zip(names, row))
+                rows[match['id']] = match
+    return rows
+
+
+def _lookup(table, ids):
+    """Return metadata rows by id, cached per table and id.
+
+    Table names come from URLs, so only taxonomy tables are accepted.
+    """
+    if table not in database.TAXONOMY_TABLES:
+        raise exception.endpoint_not_found()
+    return cache.lookup(table, ids, lambda missing: _select(table, missing))
 
 
 class Query(object):
-    """The base class for all API queries."""
+    """The base class for all API queries.
+
+    Parameters are declared once per class in a compiled spec. A fresh set of
+    parameter instances is created with every query.
+    """
+
+    _spec = parameters.Spec()
+
+    def __new__(cls, *args, **kwargs):
+        query = super(Query, cls).__new__(cls)
+        query.__dict__.update(cls._spec.make())
+        return query
 
     def __getitem__(self, key):
         if key not in self.__dict__.keys():
@@ -35,7 +154,7 @@ class Query(object):
 
     def __init__(self, **kwargs):
         for kw in kwargs:
-            if kw in self.__dict__.keys():
+            if kw in self._spec.names:
                 getattr(self, kw).value = kwargs[kw]
             elif kw == 'callback' or kw == 'api_key':
                 pass
@@ -43,9 +162,8 @@ class Query(object):
                 warnings.warn('Unsupported parameter key %s' % kw)
 
     def __iter__(self):
-        for param in self.__dict__.values():
-            if isinstance(param, parameters.Param):
-                yield (param.origin or param.key, param.value)
+        for name, origin in self._spec.origins:
+            yield (origin, self.__dict__[name].value)
 
     def __str__(self):
         return str(dict(self.__iter__()))
@@ -54,42 +172,71 @@ class Query(object):
         return list(self.__iter__())
 
     def params(self):
-        for param in self.__dict__.values():
-            if isinstance(param, parameters.Param) and param.key:
-                yield (param.key, param.value)
+        for name, key in self._spec.keys:
+            yield (key, self.__dict__[name].value)
 
 
 class SearchQuery(Query):
     """The base class for all SQL-based searches."""
 
     _default_field = 'value'
+    _spec = Query._spec.extend(
+        q=parameters.SqlQParam,
+        limit=parameters.LimitParam,
+        offset=parameters.OffsetParam
+    )
 
     def __init__(self, endpoint, **kwargs):
-        self.q = parameters.SqlQParam()
-        self.limit = parameters.LimitParam()
-        self.offset = parameters.OffsetParam()
         self._endpoint = endpoint
         super(SearchQuery, self).__init__(**kwargs)
 
+    def _fulltext(self):
+        """Translate the search pattern to a full-text query, if possible.
+
+        The trigram index narrows down candidates to values containing every
+        literal part of the pattern, which are then matched with LIKE as
+        before. Patterns without a part of at least three characters can not
+        use the index and scan the whole table.
+        """
+        if not database.fulltext():
+            return None
+        pattern = self.q.value
+        if isinstance(pattern, str):
+            pattern = pattern.decode('utf-8')
+        parts = [p for p in re.split(r'[%_]', pattern) if len(p) >= 3]
+        if not parts:
+            return None
+        return '%s : (%s)' % (self._default_field,
+            ' AND '.join('"%s"' % p.replace('"', '""') for p in parts))
+
+    def _where(self):
+        match = self._fulltext()
+        if match is None:
+            return '%s LIKE ?' % self._default_field, (self.q.value,)
+        sql = ('rowid IN (SELECT rowid FROM %s_fts WHERE %s_fts MATCH ?) '
+            'AND %s LIKE ?')
+        where = sql % (self._endpoint, self._endpoint, self._default_field)
+        return where, (match, self.q.value)
+
     def _fetch_raw(self):
-        sql = 'SELECT * FROM %s WHERE %s LIKE ? LIMIT ?, ?;'
-        query = sql % (self._endpoint, self._default_field)
-        options = (self.q.value, self.offset.value, self.limit.value)
-        result = g.db.execute(query, options).fetchall()
-        return result
+        where, options = self._where()
+        query = 'SELECT * FROM %s WHERE %s LIMIT ?, ?;' % (self._endpoint,
+            where)
+        options += (self.offset.value, self.limit.value)
+        with metrics.span('sqlite'):
+            return g.db.execute(query, options).fetchall()
 
     def _fetch_count(self):
-        sql = 'SELECT COUNT(*) FROM %s WHERE %s LIKE ?;'
-        query = sql % (self._endpoint, self._default_field)
-        result = g.db.execute(query, (self.q.value,)).fetchone()
-        return result[0]
+        where, options = self._where()
+        query = 'SELECT COUNT(*) FROM %s WHERE %s;' % (self._endpoint, where)
+        with metrics.span('sqlite'):
+            return g.db.execute(query, options).fetchone()[0]
 
     def _matches(self):
         for row in self._fetch_raw():
             match = dict()
             for key in self.fields:
-                position = self.fields.default.split(',').index(key)
-                match[key] = row[position]
+                match[key] = row[self.fields.columns[key]]
             yield match
 
     def fetch(self):
@@ -104,50 +251,65 @@ class SearchQuery(Query):
 class AuthorSearchQuery(SearchQuery):
     """Search query for content authors."""
 
-    def __init__(self, **kwargs):
-        self.fields = parameters.FieldsParam(
+    _spec = SearchQuery._spec.extend(
+        fields=parameters.FieldsParam.specialize(
             default='href,id,type,uri,value'
         )
+    )
+
+    def __init__(self, **kwargs):
         super(AuthorSearchQuery, self).__init__('author', **kwargs)
 
 
 class DepartmentSearchQuery(SearchQuery):
     """Search query for newspaper departments."""
 
-    def __init__(self, **kwargs):
-        self.fields = parameters.FieldsParam(
+    _spec = SearchQuery._spec.extend(
+        fields=parameters.FieldsParam.specialize(
             default='href,id,parent,uri,value'
         )
+    )
+
+    def __init__(self, **kwargs):
         super(DepartmentSearchQuery, self).__init__('department', **kwargs)
 
 
 class KeywordSearchQuery(SearchQuery):
     """Search query for available keywords."""
 
-    def __init__(self, **kwargs):
-        self.fields = parameters.FieldsParam(
+    _spec = SearchQuery._spec.extend(
+        fields=parameters.FieldsParam.specialize(
             default='href,id,lexical,score,type,uri,value'
         )
+    )
+
+    def __init__(self, **kwargs):
         super(KeywordSearchQuery, self).__init__('keyword', **kwargs)
 
 
 class ProductSearchQuery(SearchQuery):
     """Search query for publication products."""
 
-    def __init__(self, **kwargs):
-        self.fields = parameters.FieldsParam(
+    _spec = SearchQuery._spec.extend(
+        fields=parameters.FieldsParam.specialize(
             default='href,id,uri,value'
         )
+    )
+
+    def __init__(self, **kwargs):
         super(ProductSearchQuery, self).__init__('product', **kwargs)
 
 
 class SeriesSearchQuery(SearchQuery):
     """Search query for article series."""
 
-    def __init__(self, **kwargs):
-        self.fields = parameters.FieldsParam(
+    _spec = SearchQuery._spec.extend(
+        fields=parameters.FieldsParam.specialize(
             default='href,id,name,uri,value'
         )
+    )
+
+    def __init__(self, **kwargs):
         super(SeriesSearchQuery, self).__init__('series', **kwargs)
 
 
@@ -155,50 +317,123 @@ class ContentSearchQuery(Query):
     """Unfiltered content search query."""
 
     _endpoint = 'content'
+    _cursor_fields = ['release_date', 'uuid']
+    _epoch = '1970-01-01T00:00:00Z'
     __action = 'search'
-
-    def __init__(self, **kwargs):
-        self.q = parameters.StrParam(
+    _spec = Query._spec.extend(
+        q=parameters.StrParam.specialize(
             key='q',
             origin='q',
             default='*:*'
-        )
-        self.sort = parameters.StrParam(
+        ),
+        cursor=parameters.CursorParam,
+        sort=parameters.StrParam.specialize(
             key='sort',
             origin='sort',
             default='release_date desc'
-        )
-        self.fields = parameters.FieldsParam(
+        ),
+        fields=parameters.FieldsParam.specialize(
             default=('subtitle,uuid,title,href,release_date,'
                 'uri,snippet,supertitle,teaser_title,teaser_text'),
             enforce='uuid'
-        )
-        self.facet_date = parameters.FacetDateParam()
-        self.facet_field = parameters.FacetFieldParam()
-        self.limit = parameters.LimitParam()
-        self.offset = parameters.OffsetParam()
+        ),
+        facet_date=parameters.FacetDateParam,
+        facet_field=parameters.FacetFieldParam,
+        limit=parameters.LimitParam,
+        offset=parameters.OffsetParam
+    )
+
+    def __init__(self, **kwargs):
         super(ContentSearchQuery, self).__init__(**kwargs)
-        if self.facet_field.value != '' or self.facet_date.value != '':
-            self.facet = parameters.StrParam(
-                key='facet',
-                origin='facet',
-                default='true'
-            )
-        if self.facet_date.value != '':
-            self.facet_date_field = parameters.StrParam(
-                origin='facet.date',
-                default='release_date'
-            )
 
-    def _fetch_raw(self):
-        query = util.url_encode(dict(self))
-        url = '%s/%s/%s?%s' % (current_app.config['SOLR_URL'],
-            self.__class__._endpoint, self.__action, query)
-        try:
-            data = urllib2.urlopen(url)
-            return json.load(data)
-        except urllib2.URLError:
-            raise exception.service_unavailable()
+    def __iter__(self):
+        for item in super(ContentSearchQuery, self).__iter__():
+            yield item
+        if self._faceted():
+            yield ('facet', 'true')
+        if self.facet_date.value != '':
+            yield ('facet.date', 'release_date')
+
+    def _faceted(self):
+        return self.facet_field.value != '' or self.facet_date.value != ''
+
+    def _keyset(self):
+        """Return sort field and direction, if they allow a cursor."""
+        sort = self.sort.value.split()
+        if len(sort) != 2 or sort[0] not in self._cursor_fields:
+            raise exception.bad_request('Cursors require a sort by %s.' %
+                ' or '.join(self._cursor_fields))
+        if sort[1] not in ('asc', 'desc'):
+            raise exception.bad_request()
+        return sort[0], sort[1]
+
+    def _paginate(self, params):
+        """Replace offset paging with a keyset filter for cursor paging.
+
+        Documents are sorted by uuid within equal sort values, so the last
+        document of a page marks an unambiguous position. The next page
+        starts right after it, no matter how deep it is. Every page has its
+        own filter, so it is kept out of Solr's filter cache.
+        """
+        field, direction = self._keyset()
+        params['start'] = 0
+        if field != 'uuid':
+            params['sort'] = '%s %s,uuid %s' % (field, direction, direction)
+            if field not in params['fl'].split(','):
+                params['fl'] += ',' + field
+        if self.cursor.value == self.cursor.start:
+            return
+        position = self.cursor.decode(self.cursor.value)
+        if position[:2] != [field, direction]:
+            raise exception.bad_request('The cursor belongs to another sort.')
+        value, uuid = position[2], util.solr_escape(position[3])
+        bound = '{* TO %s}' if direction == 'desc' else '{%s TO *}'
+        if field == 'uuid':
+            keyset = 'uuid:%s' % (bound % uuid)
+        else:
+            keyset = self._beyond(field, direction, value, uuid)
+        keyset = '{!cache=false}' + keyset
+        params['fq'] = [params['fq'], keyset] if 'fq' in params else keyset
+
+    def _beyond(self, field, direction, value, uuid):
+        """Return a filter for documents sorted after the given position.
+
+        Dates are not sorted missing first or last, so Solr sorts documents
+        without a date as if they were released at the epoch. The filter
+        does the same, also for articles from before 1970.
+        """
+        value = value or self._epoch
+        bound = '{* TO %s}' if direction == 'desc' else '{%s TO *}'
+        escaped = util.solr_escape(value)
+        missing = '(*:* -%s:[* TO *])' % field
+        clauses = ['%s:%s' % (field, bound % escaped),
+            '(%s:%s AND uuid:%s)' % (field, escaped, bound % uuid)]
+        order = cmp(value.rstrip('Z'), self._epoch.rstrip('Z'))
+        if order == 0:
+            clauses.append('(%s AND uuid:%s)' % (missing, bound % uuid))
+        elif (order > 0) == (direction == 'desc'):
+            clauses.append(missing)
+        return ' OR '.join(clauses)
+
+    def _next_cursor(self, raw):
+        """Return the cursor of the next page or None on the last page."""
+        docs = raw['response']['docs']
+        if int(self.limit.value) == 0:
+            return self.cursor.value
+        if len(docs) < int(self.limit.value):
+            return None
+        field, direction = self._keyset()
+        return self.cursor.encode([field, direction, docs[-1].get(field),
+            docs[-1]['uuid']])
+
+    def _fetch_raw(self, **extra):
+        action = '%s/%s' % (self.__class__._endpoint, self.__action)
+        params = dict(self)
+        del params['cursor']
+        if self.cursor.value:
+            self._paginate(params)
+        params.update(extra)
+        return solr.fetch(action, params)
 
     def _make_matches(self, raw):
         for match in raw['response']['docs']:
@@ -213,8 +448,14 @@ class ContentSearchQuery(Query):
                 if 'uuid' not in self.fields._value:
                     del match['uuid']
 
-    def fetch(self):
-        raw = self._fetch_raw()
+    def _fetch(self, **extra):
+        raw = self._fetch_raw(**extra)
+        if self.cursor.value:
+            cursor = self._next_cursor(raw)
+            field, direction = self._keyset()
+            if field not in self.fields:
+                for match in raw['response']['docs']:
+                    match.pop(field, None)
         self._make_matches(raw)
         response = dict(
             matches=raw['response']['docs'],
@@ -222,7 +463,10 @@ class ContentSearchQuery(Query):
             limit=int(self.limit.value),
             offset=int(self.offset.value)
         )
-        if  hasattr(self, 'facet'):
+        if self.cursor.value:
+            response['cursor'] = cursor
+            response['offset'] = 0
+        if self._faceted():
             response['facets'] = dict()
             response['facets'].update(
                 raw['facet_counts']['facet_dates'])
@@ -230,34 +474,69 @@ class ContentSearchQuery(Query):
                 raw['facet_counts']['facet_fields'])
         return response
 
+    def fetch(self):
+        # Whether uuid was asked for is not part of the Solr parameters,
+        # but changes the matches.
+        key = (self.__class__.__name__, self.fields._value) + tuple(
+            sorted(self))
+        g.response_key = key
+        return cache.responses().fetch(key, self._fetch)
+
+    def _export(self):
+        while True:
+            response = self._fetch(facet='false')
+            for match in response['matches']:
+                yield json.dumps(match) + '\n'
+            if response['cursor'] is None:
+                break
+            self.cursor.value = response['cursor']
+
+    def export(self):
+        """Return a generator of all matches as lines of JSON.
+
+        Solr is queried page by page with cursors, so memory use does not
+        depend on the size of the result set. Facets are not part of the
+        export, so they are not requested either.
+        """
+        self.facet_date._value = self.facet_field._value = ''
+        self.limit.value = str(current_app.config['CONTENT_EXPORT_ROWS'])
+        self.cursor.value = self.cursor.value or self.cursor.start
+        self._keyset()
+        return self._export()
+
 
 class FilteredContentSearchQuery(ContentSearchQuery):
     """Pre-filtered search query."""
 
-    _default_field = 'id'
+    _spec = ContentSearchQuery._spec.extend(
+        fq=parameters.StrParam.specialize(origin='fq')
+    )
 
     def __init__(self, endpoint='', filter_id='', **kwargs):
-
-        self.fq = parameters.StrParam(
-            default='%s:%s' % (endpoint, filter_id),
-            origin='fq'
-        )
+        self.fq._value = '%s:%s' % (endpoint, filter_id)
         super(FilteredContentSearchQuery, self).__init__(**kwargs)
         self._endpoint = endpoint
         self._id = filter_id
 
+    def _filter(self, meta):
+        """Return the Solr filter for the given entity.
+
+        Entity pages are requested often, so Solr is asked to keep the filter
+        in its filter cache.
+        """
+        field, value = self._endpoint, self._id
+        if self._endpoint == 'author':
+            value = value.replace('-', '*')
+        elif self._endpoint == 'department' and meta['parent'] != '':
+            field = 'sub_department'
+        return '{!cache=true}%s:%s' % (field, value)
+
     def fetch(self):
-        sql = 'SELECT * FROM %s WHERE %s LIKE :q;'
-        query = sql % (self._endpoint, self._default_field)
-        result = g.db.execute(query, {'q': self._id}).fetchall()
-        if len(result) == 0:
+        result = _lookup(self._endpoint, [self._id])
+        if self._id not in result:
             raise exception.resource_not_found()
-        if self._endpoint == 'author':
-            self.fq.value = self.fq.value.replace('-', '*')
-        meta = dict(zip(QueryFactory(self._endpoint).fields, result[0]))
-        if self._endpoint == 'department':
-            if meta['parent'] != '':
-                self.fq.value = 'sub_department:%s' % (self._id)
+        meta = dict(result[self._id])
+        self.fq._value = self._filter(meta)
         meta.update(super(FilteredContentSearchQuery, self).fetch())
         return meta
 
@@ -269,14 +548,15 @@ class DisplayClientQuery(Query):
         super(DisplayClientQuery, self).__init__(**kwargs)
 
     def fetch(self):
-        row = g.db.execute('SELECT * FROM client WHERE api_key=?',
+        with metrics.span('sqlite'):
+            row = g.db.execute('SELECT * FROM client WHERE api_key=?',
                 (g.api_key,)).fetchone()
         return dict(
             api_key=row[0],
             tier=row[1],
             name=row[2],
             email=row[3],
-            requests=row[4],
+            requests=row[4] + access.ledger.pending(g.api_key),
             reset=row[5],
             quota=current_app.config['ACCESS_TIERS'][row[1]]
         )
@@ -285,10 +565,13 @@ class DisplayClientQuery(Query):
 class RegisterClientQuery(Query):
     """Register a new API client with a POST request."""
 
+    _spec = Query._spec.extend(
+        name=parameters.StrParam,
+        email=parameters.StrParam,
+        response=parameters.StrParam
+    )
+
     def __init__(self, **kwargs):
-        self.name = parameters.StrParam()
-        self.email = parameters.StrParam()
-        self.response = parameters.StrParam()
         super(RegisterClientQuery, self).__init__(**kwargs)
 
     def _verify_captcha(self):
@@ -319,91 +602,118 @@ class RegisterClientQuery(Query):
         requests = 0
         reset = int(time.time())
         query = 'INSERT INTO client VALUES (?, ?, ?, ?, ?, ?)'
-        g.db.execute(query, (g.api_key, tier, name, email, requests, reset))
+        with metrics.span('sqlite'):
+            g.db.execute(query, (g.api_key, tier, name, email, requests,
+                reset))
         return DisplayClientQuery().fetch()
 
 
 class QueryFactory(object):
     """A factory class for general endpoint queries."""
 
-    def __init__(self, endpoint='', **kwargs):
+    def __new__(cls, endpoint='', **kwargs):
         if endpoint == 'author':
-            self.__class__ = AuthorSearchQuery
+            query_class = AuthorSearchQuery
         elif endpoint == 'client':
-            self.__class__ = DisplayClientQuery
+            query_class = DisplayClientQuery
+        elif endpoint == 'content' and 'ids' in kwargs:
+            query_class = ContentBatchQuery
         elif endpoint == 'content':
-            self.__class__ = ContentSearchQuery
+            query_class = ContentSearchQuery
         elif endpoint == 'department':
-            self.__class__ = DepartmentSearchQuery
+            query_class = DepartmentSearchQuery
         elif endpoint == 'keyword':
-            self.__class__ = KeywordSearchQuery
+            query_class = KeywordSearchQuery
         elif endpoint == 'product':
-            self.__class__ = ProductSearchQuery
+            query_class = ProductSearchQuery
         elif endpoint == 'series':
-            self.__class__ = SeriesSearchQuery
+            query_class = SeriesSearchQuery
         else:
             raise exception.endpoint_not_found()
-        self.__init__(**kwargs)
+        return query_class(**kwargs)
 
 
 class ContentIdQuery(Query):
     """Display content item with the given id."""
 
     _endpoint = 'content'
+    _categories = [('department', 'department'), ('product', 'product'),
+        ('sub_department', 'department'), ('series', 'series')]
+    _sources = dict(categories=[c for c, e in _categories],
+        creators=['author'], keywords=['keyword'], relations=['related'],
+        uri=['uuid'])
     __action = 'id'
 
-    def __init__(self, content_id='', **kwargs):
-        self.fields = parameters.CsvParam(
+    _spec = Query._spec.extend(
+        fields=parameters.CsvParam.specialize(
             default=('categories,creators,href,keywords,relations,release_'
                 'date,supertitle,teaser_text,teaser_title,title,uri,uuid'),
             key='fields'
-        )
-        self.fq = parameters.StrParam(
-            default='uuid:%s' % content_id,
-            origin='fq'
-        )
-        self.q = parameters.StrParam(
+        ),
+        fq=parameters.StrParam.specialize(origin='fq'),
+        q=parameters.StrParam.specialize(
             origin='q',
             default='*:*'
         )
+    )
+
+    def __init__(self, content_id='', **kwargs):
         super(ContentIdQuery, self).__init__(**kwargs)
+        self.fq._value = 'uuid:%s' % content_id
+
+    def _solr_fields(self):
+        """Return the stored Solr fields needed for the selected fields."""
+        fields = set(['uuid'])
+        for field in self.fields:
+            fields.update(self._sources.get(field, [field]))
+        return ','.join(sorted(fields))
 
     def _fetch_raw(self):
-        query = util.url_encode(dict(self))
-        url = '%s/%s/%s?%s' % (current_app.config['SOLR_URL'],
-            self.__class__._endpoint, self.__action, query)
-        try:
-            data = urllib2.urlopen(url)
-            return json.load(data)
-        except urllib2.URLError:
-            raise exception.service_unavailable()
+        action = '%s/%s' % (self.__class__._endpoint, self.__action)
+        params = dict(self)
+        params['fl'] = self._solr_fields()
+        return solr.fetch(action, params)
+
+    def _fetch_uuids(self, uuids, fields):
+        """Fetch documents by uuid in chunks that keep request URLs short."""
+        size = current_app.config['SOLR_IDS_PER_REQUEST']
+        docs = list()
+        for i in range(0, len(uuids), size):
+            chunk = uuids[i:i + size]
+            params = dict(
+                q=util.solr_any('uuid', chunk),
+                fl=fields,
+                rows=len(chunk)
+            )
+            raw = solr.fetch('content/ids', params)
+            docs.extend(raw['response']['docs'])
+        return docs
+
+    def _lookup_categories(self, ids):
+        return dict((table, _lookup(table, ids[table])) for table in ids)
 
-    def _fetch_keywords(self, keywords):
+    def _lookup_titles(self, relations):
+        docs = self._fetch_uuids(relations, 'uuid,title')
+        return dict((d['uuid'], d['title']) for d in docs if 'title' in d)
+
+    def _fetch_keywords(self, keywords, rows):
         for keyword in keywords:
-            query = 'SELECT type, value FROM keyword WHERE id = ?;'
-            row = g.db.execute(query, (keyword,)).fetchone()
-            if row is None:
+            if keyword not in rows:
                 continue
             yield dict(
-                rel=row[0],
-                name=row[1],
+                rel=rows[keyword]['type'],
+                name=rows[keyword]['value'],
                 uri='%s/keyword/%s' % (current_app.config['API_URL'],
                     keyword)
             )
 
-    def _fetch_relations(self, relations):
+    def _fetch_relations(self, relations, titles):
         for relation in relations:
-            url = '%s/content/id?q=%s' % (current_app.config['SOLR_URL'],
-                relation)
-            solr_data = urllib2.urlopen(url)
-            try:
-                parsed = json.load(solr_data)
-                title = parsed['response']['docs'][0]['title']
-            except:
+            if relation not in titles:
                 continue
             yield dict(
                 rel='related',
-                name=title,
+                name=titles[relation],
                 uri='%s/content/%s' % (current_app.config['API_URL'],
                     relation)
             )
@@ -417,68 +727,149 @@ class ContentIdQuery(Query):
                     author.replace(' ', '-'))
             )
 
-    def _fetch_category(self, endpoint, cat_id, type):
-        query = 'SELECT value FROM %s WHERE id = "%s";' % (endpoint, cat_id)
-        row = g.db.execute(query).fetchone()
-        if row:
+    def _fetch_category(self, endpoint, cat_id, type, rows):
+        if cat_id in rows:
             yield dict(
                 rel=type,
-                name=row[0],
+                name=rows[cat_id]['value'],
                 uri='%s/%s/%s' % (current_app.config['API_URL'],
                     endpoint, cat_id)
             )
 
-    def fetch(self):
-        raw = self._fetch_raw()
-
-        if len(raw['response']['docs']) == 0:
-            raise exception.resource_not_found()
-        else:
-            doc = raw['response']['docs'][0]
+    def _resolve(self, steps):
+        """Run independent enrichment steps concurrently.
+
+        Steps map a name to a function and its argument. Return the results
+        by name and the names of all steps that missed the deadline.
+        """
+        if current_app.config['CONTENT_ENRICHMENT_THREADS'] <= 0:
+            return dict((n, f(arg)) for n, (f, arg) in steps.items()), []
+        app = current_app._get_current_object()
+        environ = request.environ
+        shared = dict(timings=getattr(g, 'timings', None),
+            generation=cache.current_generation())
+        outcomes = Queue.Queue()
+
+        def step(name, function, argument):
+            try:
+                outcomes.put((name, True, _in_context(app, environ, shared,
+                    function, argument)))
+            except Exception:
+                outcomes.put((name, False, sys.exc_info()))
+
+        deadline = time.time() + current_app.config[
+            'CONTENT_ENRICHMENT_TIMEOUT']
+        for name, (function, argument) in steps.items():
+            _submit(lambda n=name, f=function, a=argument: step(n, f, a),
+                deadline)
+        results = dict()
+        while len(results) < len(steps):
+            try:
+                name, success, result = outcomes.get(timeout=max(0,
+                    deadline - time.time()))
+            except Queue.Empty:
+                break
+            if not success:
+                raise result[0], result[1], result[2]
+            results[name] = result
+        return results, sorted(set(steps) - set(results))
+
+    def _make_docs(self, docs):
+        """Enrich documents with lookups shared by all of them."""
+        keywords = set()
+        relations = set()
+        categories = dict()
+        for doc in docs:
+            if 'keyword' in doc and 'keywords' in self.fields:
+                keywords.update(doc['keyword'])
+            if 'related' in doc and 'relations' in self.fields:
+                relations.update(doc['related'])
+            if 'categories' in self.fields:
+                for category, endpoint in self._categories:
+                    if category in doc:
+                        categories.setdefault(endpoint, set()).add(
+                            doc[category])
+
+        steps = dict()
+        if keywords:
+            steps['keywords'] = (lambda ids: _lookup('keyword', ids),
+                keywords)
+        if relations:
+            steps['relations'] = (self._lookup_titles, list(relations))
+        if categories:
+            steps['categories'] = (self._lookup_categories, categories)
+        results, missed = self._resolve(steps)
 
-        categories = [('department', 'department'), ('product', 'product'),
-            ('sub_department', 'department'), ('series', 'series')]
         whitelist = ['categories', 'creators', 'keywords', 'relations']
         blacklist = ['body']
 
-        for key in whitelist:
-            doc[key] = []
+        for doc in docs:
+            for key in whitelist:
+                doc[key] = []
+
+            for key in blacklist:
+                if key in doc:
+                    del doc[key]
 
-        for key in blacklist:
-            if key in doc:
-                del doc[key]
+            if 'uri' in self.fields:
+                doc['uri'] = '%s/%s/%s' % (current_app.config['API_URL'],
+                    self._endpoint, doc['uuid'])
+
+            if 'keyword' in doc and 'keywords' in results:
+                kw = self._fetch_keywords(doc['keyword'], results['keywords'])
+                doc['keywords'].extend(kw)
+
+            if 'related' in doc and 'relations' in results:
+                rl = self._fetch_relations(doc['related'],
+                    results['relations'])
+                doc['relations'].extend(rl)
 
-        if 'uri' in self.fields:
-            doc['uri'] = '%s/%s/%s' % (current_app.config['API_URL'],
-                self._endpoint, doc['uuid'])
+            if 'author' in doc and 'creators' in self.fields:
+                au = self._fetch_authors(doc['author'])
+                doc['creators'].extend(au)
 
-        if 'keyword' in doc and 'keywords' in self.fields:
-            kw = self._fetch_keywords(doc['keyword'])
-            doc['keywords'].extend(kw)
-            del doc['keyword']
+            for category, endpoint in self._categories:
+                if category in doc and 'categories' in results:
+                    cat = self._fetch_category(endpoint, doc[category],
+                        category, results['categories'][endpoint])
+                    doc['categories'].extend(cat)
 
-        if 'related' in doc and 'relations' in self.fields:
-            rl = self._fetch_relations(doc['related'])
-            doc['relations'].extend(rl)
-            del doc['related']
+            for key in doc.keys():
+                if key not in self.fields:
+                    del doc[key]
 
-        if 'author' in doc and 'creators' in self.fields:
-            au = self._fetch_authors(doc['author'])
-            doc['creators'].extend(au)
-            del doc['author']
+            if missed:
+                doc['partial'] = missed
 
-        for category, endpoint in categories:
-            if category in doc and 'categories' in self.fields:
-                cat_id = doc[category]
-                cat = self._fetch_category(endpoint, cat_id, category)
-                doc['categories'].extend(cat)
-                del doc[category]
+        return docs
 
-        for key in doc.keys():
-            if key not in self.fields:
-                del doc[key]
+    def fetch(self):
+        raw = self._fetch_raw()
 
-        return doc
+        if len(raw['response']['docs']) == 0:
+            raise exception.resource_not_found()
+
+        return self._make_docs(raw['response']['docs'][:1])[0]
+
+
+class ContentBatchQuery(ContentIdQuery):
+    """Display several content items with the given ids at once."""
+
+    _spec = ContentIdQuery._spec.extend(
+        ids=parameters.IdsParam
+    )
+
+    def __init__(self, **kwargs):
+        super(ContentBatchQuery, self).__init__(**kwargs)
+
+    def fetch(self):
+        raw = self._fetch_uuids(list(self.ids), self._solr_fields())
+        docs = dict((doc['uuid'], doc) for doc in raw)
+        matches = [docs[uuid] for uuid in self.ids if uuid in docs]
+        return dict(
+            matches=self._make_docs(matches),
+            found=len(matches)
+        )
 
 
 class DefinitionQuery(Query):
@@ -489,8 +880,8 @@ class DefinitionQuery(Query):
 
     def _make_def(self, endpoint, query_class):
         url = '%s/%s' % (current_app.config['API_URL'], endpoint)
-        params = dict(p for p in query_class().params())
-        doc = query_class().__doc__
+        params = dict(query_class().params())
+        doc = query_class.__doc__
         return endpoint, dict(url=url, params=params, doc=doc)
 
     def fetch(self):
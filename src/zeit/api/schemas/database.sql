@@ -37,6 +37,13 @@ CREATE TABLE IF NOT EXISTS department
 	FOREIGN KEY(parent) REFERENCES department(id)
 );
 
+CREATE TABLE IF NOT EXISTS generation
+(
+	value		UNSIGNED INTEGER	NOT NULL
+);
+
+INSERT INTO generation SELECT 0 WHERE NOT EXISTS (SELECT * FROM generation);
+
 CREATE TABLE IF NOT EXISTS keyword
 (
 	href		CHAR(128),
@@ -63,4 +70,35 @@ CREATE TABLE IF NOT EXISTS series
 	name		CHAR(128)	NOT NULL,
 	uri			CHAR(96)	NOT NULL,
 	value		CHAR(128)	NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS source
+(
+	name		CHAR(32)	NOT NULL PRIMARY KEY,
+	fingerprint	CHAR(40)	NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS metric
+(
+	process		CHAR(32)	NOT NULL PRIMARY KEY,
+	snapshot	TEXT		NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS probe
+(
+	href		CHAR(256)	NOT NULL PRIMARY KEY,
+	status		INTEGER		NOT NULL,
+	checked		REAL		NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS job
+(
+	id			INTEGER		PRIMARY KEY AUTOINCREMENT,
+	state		CHAR(16)	NOT NULL,
+	created		REAL		NOT NULL,
+	finished	REAL,
+	progress	UNSIGNED INTEGER	NOT NULL DEFAULT 0,
+	total		UNSIGNED INTEGER	NOT NULL,
+	timings		TEXT		NOT NULL DEFAULT '{}',
+	error		TEXT
 );
\ No newline at end of file
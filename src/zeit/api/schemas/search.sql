@@ -0,0 +1,46 @@
+/*
+    zeit.api.schemas.search
+    ~~~~~~~~~~~~~
+
+    These statements create full-text indexes for the metadata tables. They
+    require SQLite's FTS5 extension with its trigram tokenizer and are
+    skipped, if it is unavailable.
+
+    Copyright: (c) 2013 by ZEIT ONLINE.
+    License: BSD, see LICENSE.md for more details.
+*/
+
+CREATE VIRTUAL TABLE IF NOT EXISTS author_fts USING fts5
+(
+	value,
+	content='author',
+	tokenize='trigram'
+);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS department_fts USING fts5
+(
+	value,
+	content='department',
+	tokenize='trigram'
+);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS keyword_fts USING fts5
+(
+	value,
+	content='keyword',
+	tokenize='trigram'
+);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS product_fts USING fts5
+(
+	value,
+	content='product',
+	tokenize='trigram'
+);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS series_fts USING fts5
+(
+	value,
+	content='series',
+	tokenize='trigram'
+);
@@ -14,9 +14,19 @@ class Config(object):
 
     ACCESS_TIMEFRAME = 86400
     ACCESS_TIERS = {'free': 10000, 'pro': 50000, 'max': 1000000}
+    ACCESS_ACCOUNTING = 'immediate'
+    # Deferred accounting keeps request counts in memory per worker process,
+    # and workers do not see each other's unwritten counts. A client can
+    # exceed its quota by up to ACCESS_MAX_OVERSHOOT requests per process.
+    ACCESS_FLUSH_REQUESTS = 100
+    ACCESS_FLUSH_INTERVAL = 5
+    ACCESS_MAX_OVERSHOOT = 50
 
     SCHEMA = '/schemas/database.sql'
+    SEARCH_SCHEMA = '/schemas/search.sql'
     DATABASE = '/var/lib/zon-api/data.db'
+    DATABASE_MMAP_SIZE = 268435456
+    DATABASE_STATEMENT_CACHE = 256
     PRODUCT_ALPHABET = ''
     SERIES_ALPHABET = ''
     KEYWORD_ALPHABET = ''
@@ -24,6 +34,40 @@ class Config(object):
     RECAPTCHA_PRIVATE_KEY = ''
     RECAPTCHA_PUBLIC_KEY = ''
 
+    AUTHOR_PROBE_THREADS = 16
+    AUTHOR_PROBE_TIMEOUT = 5.0
+    AUTHOR_PROBE_INTERVAL = 604800
+    METADATA_REFRESH_INTERVAL = 0
+
+    SOLR_POOL_SIZE = 8
+    SOLR_CONNECT_TIMEOUT = 1.0
+    SOLR_READ_TIMEOUT = 10.0
+    SOLR_BACKGROUND_TIMEOUT = 600.0
+    SOLR_BREAKER_THRESHOLD = 0.5
+    SOLR_BREAKER_WINDOW = 20
+    SOLR_BREAKER_COOLDOWN = 30.0
+    SOLR_HEDGE_REQUESTS = False
+    SOLR_HEDGE_PERCENTILE = 95
+    SOLR_HEALTH_INTERVAL = 5.0
+    SOLR_IDS_PER_REQUEST = 100
+
+    TAXONOMY_CACHE_SIZE = 65536
+    CONTENT_CACHE_SIZE = 67108864
+    CONTENT_CACHE_TTL = 60
+    CONTENT_ENRICHMENT_THREADS = 8
+    CONTENT_ENRICHMENT_TIMEOUT = 2.0
+    CONTENT_EXPORT_ROWS = 1024
+    DEFINITION_MAX_AGE = 86400
+    STREAM_MIN_MATCHES = 100
+    STREAM_CHUNK_SIZE = 65536
+    COMPRESSION_LEVEL = 6
+    COMPRESSION_MIN_SIZE = 1024
+
+    METRICS_SERVER_TIMING = True
+    METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+        5.0, 10.0)
+    METRICS_PUBLISH_INTERVAL = 5
+
     try:
         import private
         PRODUCT_ALPHABET = private.PRODUCT_ALPHABET
@@ -39,6 +83,7 @@ class ProductionConfig(Config):
     DOC_URL = 'https://developer.zeit.de'
     API_URL = 'https://api.zeit.de'
     SOLR_URL = 'http://127.0.0.1:8983/solr'
+    ACCESS_ACCOUNTING = 'deferred'
 
     try:
         import private
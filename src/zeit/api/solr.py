@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+"""
+    zeit.api.solr
+    ~~~~~~~~~~~~~
+
+    This module contains the HTTP client used for all requests to the Solr
+    replicas. Connections are kept alive in a per-process pool for each
+    replica and responses are transferred gzip compressed. Requests are
+    routed to the healthy replica with the fewest outstanding requests. A
+    circuit breaker stops sending requests to a failing replica for a while,
+    and slow requests can be hedged by a second one.
+
+    Copyright: (c) 2013 by ZEIT ONLINE.
+    License: BSD, see LICENSE.md for more details.
+"""
+
+import Queue
+import collections
+import httplib
+import json
+import math
+import os
+import random
+import select
+import socket
+import sys
+import threading
+import time
+import urlparse
+import zlib
+
+from flask import current_app
+
+from . import exception, metrics, util
+
+
+class SolrError(Exception):
+    """Raised when the Solr server can not be reached or fails to answer."""
+
+    def __init__(self, message, status=None):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class _Hedged(Exception):
+    """Raised in place of a late response when its hedge answered first."""
+
+
+class CircuitBreaker(object):
+    """Rejects requests for a while once too many recent requests failed.
+
+    After the cooldown a single request is let through. If it succeeds, the
+    breaker closes again, otherwise it stays open for another cooldown.
+    """
+
+    def __init__(self, threshold=0.5, window=20, cooldown=30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.opened = None
+        self._outcomes = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Tell whether a request may be sent."""
+        with self._lock:
+            if self.opened is None:
+                return True
+            if self.opened + self.cooldown > time.time():
+                return False
+            self.opened = time.time()
+            return True
+
+    def record(self, success):
+        """Record the outcome of a request."""
+        with self._lock:
+            if self.opened is not None:
+                self.opened = None if success else time.time()
+                self._outcomes.clear()
+                return
+            self._outcomes.append(success)
+            failures = self._outcomes.count(False)
+            if len(self._outcomes) == self._outcomes.maxlen and \
+                    failures >= self.threshold * len(self._outcomes):
+                self.opened = time.time()
+
+
+class ConnectionPool(object):
+    """A bounded, thread-safe pool of keep-alive connections to one host.
+
+    Connecting and reading time out separately, so an unreachable server is
+    detected quickly while slow queries still get to finish.
+    """
+
+    def __init__(self, url, size=8, connect_timeout=1.0, read_timeout=10.0,
+            breaker=None):
+        parts = urlparse.urlsplit(url)
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path.rstrip('/')
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.breaker = breaker or CircuitBreaker()
+        self._idle = Queue.LifoQueue(size)
+
+    def _connect(self):
+        if self.scheme == 'https':
+            conn = httplib.HTTPSConnection(self.host, self.port,
+                timeout=self.connect_timeout)
+        else:
+            conn = httplib.HTTPConnection(self.host, self.port,
+                timeout=self.connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(self.read_timeout)
+        return conn
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait(), True
+        except Queue.Empty:
+            return self._connect(), False
+
+    def _release(self, conn):
+        try:
+            self._idle.put_nowait(conn)
+        except Queue.Full:
+            conn.close()
+
+    def close(self):
+        """Close all idle connections."""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Queue.Empty:
+                return
+
+    def ping(self):
+        """Tell whether the server answers its ping handler."""
+        try:
+            conn = self._connect()
+            try:
+                conn.request('GET', self.path + '/admin/ping?wt=json')
+                response = conn.getresponse()
+                response.read()
+                return response.status == 200
+            finally:
+                conn.close()
+        except (httplib.HTTPException, socket.error):
+            return False
+
+    def request(self, action, query='', wait=None, timeout=None):
+        """Send a GET request and return the decompressed response body.
+
+        If given, wait is called with the socket once the request is sent,
+        and timeout replaces the read timeout for this request.
+        """
+        url = '%s/%s?%s' % (self.path, action, query)
+        headers = {'Accept-Encoding': 'gzip', 'Connection': 'keep-alive'}
+        while True:
+            conn, reused = None, False
+            try:
+                conn, reused = self._acquire()
+                conn.sock.settimeout(timeout or self.read_timeout)
+                conn.request('GET', url, headers=headers)
+                if wait is not None:
+                    wait(conn.sock)
+                response = conn.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error), e:
+                if conn is not None:
+                    conn.close()
+                if reused:
+                    # The server may have dropped an idle connection.
+                    continue
+                raise SolrError(e)
+            except:
+                if conn is not None:
+                    conn.close()
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                self._release(conn)
+            break
+        if response.status != 200:
+            raise SolrError('%d: %s' % (response.status, response.reason),
+                response.status)
+        if response.getheader('content-encoding', '') == 'gzip':
+            try:
+                body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+            except zlib.error, e:
+                raise SolrError(e)
+        return body
+
+
+class Balancer(object):
+    """Routes requests to the replica with the fewest outstanding requests.
+
+    Replicas failing their health check are taken out of rotation until
+    they answer again. If no replica is healthy, all of them are tried.
+    """
+
+    def __init__(self, nodes, interval=5.0):
+        self.nodes = list(nodes)
+        self.healthy = dict((node, True) for node in self.nodes)
+        self.outstanding = dict((node, 0) for node in self.nodes)
+        self._latencies = collections.deque(maxlen=200)
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        if len(self.nodes) > 1 and interval:
+            thread = threading.Thread(target=self._check, args=(interval,))
+            thread.daemon = True
+            thread.start()
+
+    def _check(self, interval):
+        """Ping all replicas in the given interval, until closed."""
+        while not self._closed.wait(interval):
+            for node in self.nodes:
+                self.healthy[node] = node.ping()
+
+    def acquire(self, exclude=(), background=False):
+        """Return the replica to send the next request to, or None.
+
+        Background requests do not ask the circuit breakers, so they never
+        take the trial request of an open breaker.
+        """
+        with self._lock:
+            nodes = [node for node in self.nodes if node not in exclude]
+            nodes = [node for node in nodes if self.healthy[node]] or nodes
+            nodes.sort(key=lambda node: (self.outstanding[node],
+                random.random()))
+            for node in nodes:
+                if background or node.breaker.allow():
+                    self.outstanding[node] += 1
+                    return node
+        return None
+
+    def release(self, node):
+        """Mark a request to the given replica as finished."""
+        with self._lock:
+            self.outstanding[node] -= 1
+
+    def close(self):
+        """Stop health checks and close all idle connections."""
+        self._closed.set()
+        for node in self.nodes:
+            node.close()
+
+    def latency(self, fraction):
+        """Return a percentile of recent response times.
+
+        None is returned until enough responses were received.
+        """
+        with self._lock:
+            timings = sorted(self._latencies)
+        if len(timings) < self._latencies.maxlen // 10:
+            return None
+        return timings[max(int(math.ceil(fraction * len(timings))), 1) - 1]
+
+    def request(self, action, query='', wait=None, timeout=None,
+            background=False):
+        """Send a GET request to a replica and return the response body.
+
+        If a replica fails to answer, the request is sent to another one.
+        Outcomes and response times of background requests are not
+        recorded, so slow jobs neither open breakers nor delay hedging.
+        """
+        tried = list()
+        while True:
+            node = self.acquire(tried, background)
+            if node is None:
+                raise SolrError('No Solr server available.')
+            tried.append(node)
+            started = time.time()
+            try:
+                body = node.request(action, query, wait, timeout)
+            except SolrError, e:
+                # Rejected queries are answered by a healthy server.
+                rejected = e.status is not None and e.status < 500
+                if not background:
+                    node.breaker.record(rejected)
+                if rejected or len(tried) > 1 or len(self.nodes) == 1:
+                    raise
+                continue
+            finally:
+                self.release(node)
+            if not background:
+                node.breaker.record(True)
+                with self._lock:
+                    self._latencies.append(time.time() - started)
+            return body
+
+
+_balancers = dict()
+_balancers_pid = None
+_balancers_lock = threading.Lock()
+
+
+def balancer():
+    """Return the balancer of the configured Solr replicas.
+
+    SOLR_URL is either a single address or a list of them. Balancers are
+    created lazily and per process, so connections are never shared between
+    forked workers.
+    """
+    global _balancers_pid
+    config = current_app.config
+    urls = config['SOLR_URL']
+    if isinstance(urls, basestring):
+        urls = (urls,)
+    key = tuple(urls)
+    with _balancers_lock:
+        if _balancers_pid != os.getpid():
+            _balancers.clear()
+            _balancers_pid = os.getpid()
+        if key not in _balancers:
+            nodes = [ConnectionPool(url, size=config['SOLR_POOL_SIZE'],
+                connect_timeout=config['SOLR_CONNECT_TIMEOUT'],
+                read_timeout=config['SOLR_READ_TIMEOUT'],
+                breaker=CircuitBreaker(config['SOLR_BREAKER_THRESHOLD'],
+                    config['SOLR_BREAKER_WINDOW'],
+                    config['SOLR_BREAKER_COOLDOWN'])) for url in urls]
+            _balancers[key] = Balancer(nodes, config['SOLR_HEALTH_INTERVAL'])
+        return _balancers[key]
+
+
+def hedged(request, delay, timeout):
+    """Send a request and, if it is not answered within delay, once more.
+
+    The request is called with a function, which is to be called with the
+    socket once the request is sent. The first attempt runs in the calling
+    thread. Only if it did not start to answer within delay, a second one
+    is sent from another thread and the first answer wins. Errors are
+    raised if both attempts fail, or the second does not answer within
+    timeout after the first failed.
+    """
+    results = Queue.Queue()
+    state = dict(started=False, done=False)
+
+    def attempt():
+        try:
+            results.put((True, request()))
+        except Exception, e:
+            results.put((False, e))
+
+    def wait(sock):
+        if state['started'] or select.select([sock], [], [], delay)[0]:
+            return
+        thread = threading.Thread(target=attempt)
+        thread.daemon = True
+        thread.start()
+        state['started'] = True
+        while not select.select([sock], [], [], 0.01)[0]:
+            try:
+                success, result = results.get_nowait()
+            except Queue.Empty:
+                continue
+            state['done'] = True
+            if success:
+                raise _Hedged(result)
+            return
+
+    try:
+        return request(wait)
+    except _Hedged, e:
+        return e.args[0]
+    except Exception:
+        error = sys.exc_info()
+        if not state['started'] or state['done']:
+            raise error[0], error[1], error[2]
+        try:
+            success, result = results.get(timeout=timeout)
+        except Queue.Empty:
+            success = False
+        if not success:
+            raise error[0], error[1], error[2]
+        return result
+
+
+def fetch_raw(action, params, background=False):
+    """Query a Solr request handler and return the raw response body.
+
+    Requests fail right away while the circuit breakers of all replicas
+    are open. If hedging is enabled, requests taking longer than the
+    configured percentile of recent response times are sent a second time,
+    which usually goes to another replica.
+
+    Background requests, like those of metadata updates, are neither
+    hedged nor rejected by open breakers, and they get their own read
+    timeout, SOLR_BACKGROUND_TIMEOUT.
+    """
+    config = current_app.config
+    replicas = balancer()
+    query = util.url_encode(params)
+    if background:
+        with metrics.span('solr'):
+            return replicas.request(action, query,
+                timeout=config['SOLR_BACKGROUND_TIMEOUT'], background=True)
+    delay = None
+    if config['SOLR_HEDGE_REQUESTS']:
+        delay = replicas.latency(config['SOLR_HEDGE_PERCENTILE'] / 100.0)
+    try:
+        with metrics.span('solr'):
+            if delay is None:
+                return replicas.request(action, query)
+            return hedged(lambda wait=None: replicas.request(action, query,
+                wait), delay, config['SOLR_READ_TIMEOUT'])
+    except SolrError:
+        raise exception.service_unavailable()
+
+
+def fetch(action, params):
+    """Query a Solr request handler and return the parsed JSON response."""
+    return json.loads(fetch_raw(action, params))
@@ -8,12 +8,23 @@
     Copyright: (c) 2013 by ZEIT ONLINE.
     License: BSD, see LICENSE.md for more details.
 """
+import itertools
 import json
+import os
 import random
+import shutil
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
 import werkzeug
 
-from . import application
+from flask import g
+
+from . import application, cache, database, metadata, metrics, queries
+from . import solr
 
 
 class ClientTestCase(unittest.TestCase):
@@ -51,6 +62,20 @@ class ClientTestCase(unittest.TestCase):
         resp = self.client.get('/client', headers=headers)
         self.assertEqual(resp.status_code, 200)
 
+    def test_deferred_accounting(self):
+        """Deferred request counts are written without further requests."""
+        config = self.client.application.config
+        config['ACCESS_ACCOUNTING'] = 'deferred'
+        config['ACCESS_FLUSH_INTERVAL'] = 0.3
+        query_string = dict(api_key=self.parsed['api_key'])
+        for i in range(2):
+            self.client.get('/client', query_string=query_string)
+        time.sleep(1)
+        db = sqlite3.connect(config['DATABASE'])
+        row = db.execute('SELECT requests FROM client WHERE api_key=?;',
+            (self.parsed['api_key'],)).fetchone()
+        self.assertEqual(row[0], 2)
+
 
 class QueryTestCase(unittest.TestCase):
 
@@ -80,6 +105,140 @@ class QueryTestCase(unittest.TestCase):
                     for i in list(ids):
                         self.__get_json('/' + path + '/' + i)
 
+    def test_definition_caching(self):
+        """Definition is served with an ETag and long-lived headers."""
+        resp = self.client.get('/', headers=self.headers)
+        self.assertTrue(resp.headers['ETag'])
+        self.assertTrue('public' in resp.headers['Cache-Control'])
+        headers = werkzeug.datastructures.Headers(self.headers)
+        headers.add('If-None-Match', resp.headers['ETag'])
+        resp = self.client.get('/', headers=headers)
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, '')
+
+    def test_metrics(self):
+        """Timings are sent per request and exported per endpoint."""
+        resp = self.client.get('/author', headers=self.headers)
+        self.assertTrue('sqlite;dur=' in resp.headers['Server-Timing'])
+        self.assertTrue('total;dur=' in resp.headers['Server-Timing'])
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        self.client.get('/garbage', headers=self.headers)
+        self.client.get('/garbage/id')
+        resp = self.client.get('/metrics', headers=self.headers)
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue('zeit_api_request_duration_seconds_count{endpoint='
+            '"/author"}' in resp.data)
+        self.assertFalse('garbage' in resp.data)
+
+    def test_metrics_processes(self):
+        """Metrics are summed up over all processes, also ended ones."""
+        self.client.get('/author', headers=self.headers)
+        name = 'zeit_api_request_duration_seconds'
+        labels = [['endpoint', '/author']]
+
+        def count():
+            resp = self.client.get('/metrics', headers=self.headers)
+            line = '%s_count{endpoint="/author"} ' % name
+            return int(resp.data.split(line)[1].split()[0])
+
+        before = count()
+        with self.client.application.test_request_context():
+            db = database.connect()
+            buckets = len(self.client.application.config['METRICS_BUCKETS'])
+            snapshot = dict(cache=[1, 0, 0], histograms=[[name, labels,
+                [3] + [0] * buckets, 0.3]])
+            db.execute('REPLACE INTO metric VALUES (?, ?);', ('other',
+                json.dumps(snapshot)))
+            self.assertEqual(count(), before + 3)
+            metrics.retire(db)
+            rows = dict(db.execute('SELECT * FROM metric;').fetchall())
+            db.execute('DELETE FROM metric;')
+        self.assertEqual(sorted(rows), ['other', 'retired'])
+        retired = json.loads(rows['retired'])
+        self.assertEqual([sum(h[2]) for h in retired['histograms']
+            if h[:2] == [name, labels]], [before])
+
+    def test_enrichment_deadline(self):
+        """Slow enrichment steps make responses partial but block nothing."""
+        config = self.client.application.config
+        config['CONTENT_ENRICHMENT_TIMEOUT'] = 0.1
+        config['CONTENT_ENRICHMENT_THREADS'] = 4
+        uuid = self.__get_json('/content?limit=1')['matches'][0]['uuid']
+        threads = threading.active_count()
+        lookup = queries._lookup
+        queries._lookup = lambda table, ids: time.sleep(1) or dict()
+        try:
+            for i in range(8):
+                resp = self.__get_json('/content/%s?fields=keywords' % uuid)
+                self.assertEqual(resp['partial'], ['keywords'])
+            self.assertTrue(threading.active_count() <= threads + 4)
+        finally:
+            queries._lookup = lookup
+        time.sleep(1.5)
+        resp = self.__get_json('/content/%s?fields=keywords' % uuid)
+        self.assertFalse('partial' in resp)
+
+    def test_unknown_entity_endpoint(self):
+        """Entity pages exist only for the taxonomy tables."""
+        for endpoint in ['garbage', 'client', 'sqlite_master']:
+            resp = self.client.get('/%s/id' % endpoint, headers=self.headers)
+            self.assertEqual(resp.status_code, 404)
+
+    def test_content_batch(self):
+        """Batches return known ids in the requested order."""
+        found = self.__get_json('/content?limit=5&fields=uuid')['matches']
+        ids = [match['uuid'] for match in reversed(found)]
+        batch = self.__get_json('/content?ids=' + ','.join(ids))
+        self.assertEqual([match['uuid'] for match in batch['matches']], ids)
+        self.assertEqual(batch['found'], len(ids))
+
+    def test_content_batch_maximum(self):
+        """Batches of the maximum size are split into several requests."""
+        found = self.__get_json('/content?limit=1024&fields=uuid')['matches']
+        ids = [match['uuid'] for match in found]
+        ids += ['unknown-%d' % i for i in range(1024 - len(ids))]
+        batch = self.__get_json('/content?ids=' + ','.join(ids))
+        self.assertEqual(batch['found'], len(found))
+
+    def test_content_batch_unknown(self):
+        """Unknown ids are left out of batches."""
+        batch = self.__get_json('/content?ids=unknown-1,unknown-2')
+        self.assertEqual(batch, dict(matches=[], found=0))
+
+    def test_content_export(self):
+        """Exports stream all matches as lines of JSON, without facets."""
+        found = self.__get_json('/content?limit=0')['found']
+        self.client.application.config['CONTENT_EXPORT_ROWS'] = 7
+        requests, fetch = [], solr.fetch
+        solr.fetch = lambda action, params: (requests.append(params) or
+            fetch(action, params))
+        try:
+            resp = self.client.get('/content/export?facet_field=author',
+                headers=self.headers)
+            lines = resp.data.splitlines()
+        finally:
+            solr.fetch = fetch
+        uuids = set(json.loads(line)['uuid'] for line in lines)
+        self.assertEqual(len(uuids), found)
+        self.assertTrue(len(requests) > 1)
+        for params in requests:
+            self.assertEqual(params['facet'], 'false')
+            self.assertEqual(params['facet.field'], '')
+
+    def test_content_export_empty(self):
+        """Exports of empty results are empty."""
+        resp = self.client.get('/content/export?q=uuid:unknown',
+            headers=self.headers)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, '')
+
+    def test_cached_fields(self):
+        """Cached responses keep the fields of the request."""
+        match = self.__get_json('/content?fields=title')['matches'][0]
+        self.assertFalse('uuid' in match)
+        match = self.__get_json('/content?fields=uuid,title')['matches'][0]
+        self.assertTrue('uuid' in match)
+
     def test_parameter_defaults(self):
         """Parameters accepting their default values."""
         for endpoint, definition in self.__get_json('/').items():
@@ -119,6 +278,17 @@ class ParameterTestCase(unittest.TestCase):
             expected = rnd + '(' + json_resp.data + ');'
             self.assertEqual(expected, jsonp_resp.data)
 
+    def test_streamed_response(self):
+        """Streamed responses equal buffered ones, also as JSONP."""
+        config = self.client.application.config
+        query_string = dict(limit=5, callback='cb')
+        expected = [self.client.get('/content', headers=self.headers,
+            query_string=qs).data for qs in [dict(limit=5), query_string]]
+        config['STREAM_MIN_MATCHES'], config['STREAM_CHUNK_SIZE'] = 1, 64
+        streamed = [self.client.get('/content', headers=self.headers,
+            query_string=qs).data for qs in [dict(limit=5), query_string]]
+        self.assertEqual(expected, streamed)
+
     def test_limit_parameter(self):
         """Limit parameter behaves as expected."""
         for ep in self.endpoints:
@@ -153,6 +323,71 @@ class ParameterTestCase(unittest.TestCase):
                 )
                 self.assertEqual(resp.status_code, code)
 
+    def test_cursor_parameter(self):
+        """Cursor parameter pages without overlap."""
+        seen = []
+        cursor = '*'
+        for page in range(3):
+            resp = self.client.get(
+                '/content',
+                query_string=dict(cursor=cursor, limit=5),
+                headers=self.headers
+            )
+            parsed = json.loads(resp.data)
+            uuids = [match['uuid'] for match in parsed['matches']]
+            self.assertFalse(set(uuids) & set(seen))
+            seen.extend(uuids)
+            cursor = parsed['cursor']
+        for query_string in [dict(cursor='invalid'),
+                dict(cursor='*', sort='title asc')]:
+            resp = self.client.get(
+                '/content',
+                query_string=query_string,
+                headers=self.headers
+            )
+            self.assertEqual(resp.status_code, 400)
+
+    def test_cursor_missing_value(self):
+        """Cursors sort documents without a date at the epoch, like Solr."""
+        missing = '(*:* -release_date:[* TO *])'
+        query = queries.ContentSearchQuery(cursor='*', limit='1')
+        filters = []
+        for doc in [dict(uuid='b'), dict(uuid='a', release_date=
+                '2013-01-01T00:00:00Z'), dict(uuid='c', release_date=
+                '1946-02-21T00:00:00Z')]:
+            cursor = query._next_cursor(dict(response=dict(docs=[doc])))
+            params = dict(fl='uuid')
+            queries.ContentSearchQuery(cursor=cursor)._paginate(params)
+            self.assertTrue(params['fq'].startswith('{!cache=false}'))
+            filters.append(params['fq'])
+        self.assertTrue('release_date:{* TO 1970' in filters[0])
+        self.assertTrue(filters[0].endswith('(%s AND uuid:{* TO b})' %
+            missing))
+        self.assertTrue(filters[1].endswith(' OR ' + missing))
+        self.assertFalse(missing in filters[2])
+
+    def test_parameter_isolation(self):
+        """Queries of the same class do not share parameter values."""
+        first = queries.QueryFactory('keyword', limit='5', fields='id')
+        second = queries.QueryFactory('keyword')
+        self.assertEqual(first.limit.value, '5')
+        self.assertEqual(second.limit.value, '10')
+        self.assertEqual(sorted(second.fields), sorted(second.fields.columns))
+
+    def test_entity_filter(self):
+        """Entity pages filter with cached Solr filter queries."""
+        query = queries.FilteredContentSearchQuery('author', 'Jane-Doe')
+        self.assertEqual(query._filter(dict(id='Jane-Doe')),
+            '{!cache=true}author:Jane*Doe')
+        query = queries.FilteredContentSearchQuery('department', 'ausland')
+        self.assertEqual(query._filter(dict(parent='politik')),
+            '{!cache=true}sub_department:ausland')
+
+    def test_content_id_filter(self):
+        """Clients cannot replace the id filter of content items."""
+        query = queries.ContentIdQuery('abc', fq='*:*')
+        self.assertEqual(dict(query)['fq'], 'uuid:abc')
+
     def test_fields_parameter(self):
         """Fields parameter behaves as expected."""
         for ep in self.endpoints:
@@ -177,5 +412,233 @@ class ParameterTestCase(unittest.TestCase):
                     self.assertTrue(sd.issubset(['snippet']))
 
 
+class CacheTestCase(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        """Least recently used entries are evicted first."""
+        lru = cache.LRUCache(2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual(lru.get('a'), 1)
+        self.assertEqual(lru.get('b'), None)
+        self.assertEqual(len(lru), 2)
+
+    def test_generation(self):
+        """Entries are dropped when the generation changes."""
+        lru = cache.LRUCache()
+        lru.validate(1)
+        lru.set('a', 1)
+        lru.validate(1)
+        self.assertEqual(lru.get('a'), 1)
+        lru.validate(2)
+        self.assertEqual(lru.get('a'), None)
+
+    def test_response_cache(self):
+        """Results are bounded in size, expire and count hits."""
+        responses = cache.ResponseCache(size=20, ttl=60)
+        responses.set('a', dict(found=1))
+        responses.set('b', dict(found=2))
+        self.assertEqual(responses.get('a'), None)
+        self.assertEqual(responses.get('b'), dict(found=2))
+        self.assertEqual((responses.hits, responses.misses), (1, 1))
+        responses.ttl = -1
+        responses.set('c', dict(found=3))
+        self.assertEqual(responses.get('c'), None)
+
+    def test_response_variants(self):
+        """Variants are stored with their entry and count towards its size."""
+        responses = cache.ResponseCache(size=30, ttl=60)
+        responses.set_variant('a', 'gzip', 'ignored')
+        self.assertEqual(responses.get_variant('a', 'gzip'), None)
+        responses.set('a', dict(found=1))
+        responses.set_variant('a', 'gzip', 'x' * 8)
+        self.assertEqual(responses.get_variant('a', 'gzip'), 'x' * 8)
+        self.assertEqual(responses.used, 20)
+        responses.set('b', dict(found=2))
+        self.assertEqual(responses.get_variant('a', 'gzip'), None)
+        self.assertEqual(responses.used, 12)
+
+
+class MetadataTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = application.test_client_factory().application
+        self.directory = tempfile.mkdtemp()
+        self.app.config['DATABASE'] = os.path.join(self.directory, 'data.db')
+        self.write('PRODUCT_ALPHABET', '<products><product id="ZEI" '
+            'href="http://www.zeit.de/zeit">Die Zeit</product></products>')
+        self.write('SERIES_ALPHABET', '<series_list><series url="reise" '
+            'title="Reise" serienname="Reise"/></series_list>')
+        self.write('KEYWORD_ALPHABET', '<tags><tag url_value="klima" '
+            'lexical_value="klima" type="topic" freq="3">Klima</tag></tags>')
+        self.write('DEPARTMENT_ALPHABET', '<lists><list id="sitemap"><link '
+            'label="politik" href="http://www.zeit.de/politik/index">Politik'
+            '</link></list></lists>')
+        self.fetch_raw = solr.fetch_raw
+        solr.fetch_raw = lambda action, params, background=False: (
+            '<response><lst name="author"><int name="Jane Doe">3</int></lst>'
+            '</response>')
+
+    def tearDown(self):
+        solr.fetch_raw = self.fetch_raw
+        shutil.rmtree(self.directory)
+
+    def write(self, source, xml):
+        path = os.path.join(self.directory, source.lower() + '.xml')
+        with open(path, 'w') as f:
+            f.write(xml)
+        self.app.config[source] = path
+
+    def test_update(self):
+        """Changes are written with a new generation, even if a later
+        source fails, and unchanged sources are skipped."""
+        with self.app.test_request_context():
+            db = database.connect()
+            db.execute('INSERT INTO probe VALUES (?, ?, ?);', ('http://www.'
+                'zeit.de/autoren/D/Jane_Doe/index.xml', 200, time.time()))
+            metadata.update(db)
+            generation = cache.generation(db)
+            self.assertTrue(generation > 0)
+            row = db.execute('SELECT href, value FROM author;').fetchone()
+            self.assertEqual(row[1], 'Jane Doe')
+            self.assertTrue(row[0].endswith('Jane_Doe/index.xml'))
+            if database.fulltext():
+                query = ('SELECT rowid FROM keyword_fts WHERE keyword_fts '
+                    'MATCH ?;')
+                self.assertEqual(len(db.execute(query, ('Klima',)).fetchall()),
+                    1)
+
+            metadata.update(db)
+            self.assertEqual(cache.generation(db), generation)
+
+            self.write('KEYWORD_ALPHABET', '<tags><tag url_value="klima" '
+                'lexical_value="klima" type="topic" freq="3">Klimawandel'
+                '</tag></tags>')
+
+            def unavailable(action, params, background=False):
+                raise solr.SolrError('Solr is unavailable.')
+            solr.fetch_raw = unavailable
+            self.assertRaises(solr.SolrError, metadata.update, db)
+            row = db.execute('SELECT value FROM keyword;').fetchone()
+            self.assertEqual(row[0], 'Klimawandel')
+            self.assertTrue(cache.generation(db) > generation)
+
+
+class SearchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = application.test_client_factory().application
+        self.directory = tempfile.mkdtemp()
+        self.app.config['DATABASE'] = os.path.join(self.directory, 'data.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_fulltext(self):
+        """Full-text searches find the same values as plain LIKE scans."""
+        values = [u'Klimawandel', u'\xd6sterreich', u'M\xfcller',
+            u'R\xf6mer', u'Rom', u'Stra\xdfe', u'Caf\xe9 "Einstein"']
+        patterns = [u'*rom*', u'R\xf6m*', u'*\xd6STER*', u'*ster*',
+            u'*\xfc*', u'Rom', u'*a*e*', u'*"ein*', u'kl_ma*', u'*']
+        with self.app.test_request_context():
+            g.db = database.connect()
+            g.db.executemany('INSERT INTO keyword VALUES (?, ?, ?, ?, ?, ?, '
+                '?);', [('', 'kw%d' % i, '', 0, 'subject', '', v)
+                for i, v in enumerate(values)])
+            database.rebuild_fulltext(g.db, 'keyword')
+            for q in patterns:
+                query = queries.QueryFactory('keyword', q=q, fields='id',
+                    limit='100')
+                parts = q.replace('_', '*').split('*')
+                if database.fulltext() and max(map(len, parts)) >= 3:
+                    self.assertNotEqual(query._fulltext(), None)
+                found = sorted(m['id'] for m in query.fetch()['matches'])
+                expected = sorted(row[0] for row in g.db.execute(
+                    'SELECT id FROM keyword WHERE value LIKE ?;',
+                    (q.replace('*', '%'),)))
+                self.assertEqual(found, expected)
+
+
+class SolrTestCase(unittest.TestCase):
+
+    def test_circuit_breaker(self):
+        """Breaker opens on failures and lets a trial request through."""
+        breaker = solr.CircuitBreaker(threshold=0.5, window=4, cooldown=60)
+        for success in (True, False, True):
+            breaker.record(success)
+        self.assertTrue(breaker.allow())
+        breaker.record(False)
+        self.assertFalse(breaker.allow())
+        breaker.opened -= 61
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record(True)
+        self.assertTrue(breaker.allow())
+
+    def test_balancer(self):
+        """Requests go to healthy replicas with fewest outstanding requests."""
+        first, second = [solr.ConnectionPool(url) for url in
+            ('http://first/solr', 'http://second/solr')]
+        replicas = solr.Balancer([first, second], interval=0)
+        replicas.outstanding[first] = 2
+        self.assertEqual(replicas.acquire(), second)
+        replicas.healthy[second] = False
+        self.assertEqual(replicas.acquire(), first)
+        replicas.healthy[first] = False
+        self.assertEqual(replicas.acquire(), second)
+        self.assertEqual(replicas.acquire(exclude=[second]), first)
+
+    def test_background_request(self):
+        """Background requests neither need nor move circuit breakers."""
+        node = solr.ConnectionPool('http://first/solr',
+            breaker=solr.CircuitBreaker(window=2))
+        replicas = solr.Balancer([node], interval=0)
+        timeouts = []
+
+        def request(action, query='', wait=None, timeout=None):
+            timeouts.append(timeout)
+            raise solr.SolrError('Timed out.')
+        node.request = request
+        for i in range(2):
+            self.assertRaises(solr.SolrError, replicas.request, 'select',
+                timeout=600.0, background=True)
+        self.assertEqual(timeouts, [600.0, 600.0])
+        self.assertTrue(node.breaker.allow())
+        for i in range(2):
+            self.assertRaises(solr.SolrError, replicas.request, 'select')
+        self.assertFalse(node.breaker.allow())
+        self.assertEqual(replicas.acquire(background=True), node)
+
+    def test_hedged_request(self):
+        """Late requests are overtaken by a second one, prompt ones not."""
+        calls = itertools.count()
+        sock, peer = socket.socketpair()
+
+        def request(wait=None):
+            call = next(calls)
+            if wait is not None:
+                wait(sock)
+            return call
+        self.assertEqual(solr.hedged(request, 0.01, 1.0), 1)
+        peer.send('answer')
+        self.assertEqual(solr.hedged(request, 0.01, 1.0), 2)
+        self.assertEqual(next(calls), 3)
+
+    def test_hedged_failure(self):
+        """Failing hedges do not block the request."""
+        sock, peer = socket.socketpair()
+
+        def request(wait=None):
+            if wait is None:
+                raise ValueError()
+            wait(sock)
+            raise solr.SolrError('Late and failed.')
+        started = time.time()
+        self.assertRaises(solr.SolrError, solr.hedged, request, 0.01, 60.0)
+        self.assertTrue(time.time() - started < 1.0)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -9,6 +9,7 @@
     License: BSD, see LICENSE.md for more details.
 """
 
+import json
 import re
 import urllib
 import urlparse
@@ -59,6 +60,22 @@ def iri_to_uri(iri):
     )
 
 
+def json_chunks(document, indent=None, prefix='', suffix='', size=8192):
+    """Encode a document to JSON bit by bit, in chunks of about size bytes."""
+
+    chunk = [prefix]
+    length = len(prefix)
+    for piece in json.JSONEncoder(indent=indent).iterencode(document):
+        chunk.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield ''.join(chunk)
+            chunk = []
+            length = 0
+    chunk.append(suffix)
+    yield ''.join(chunk)
+
+
 def save_xpath(element, xpath, fallback=''):
     """Safely return the first result of an xpath expression."""
 
@@ -68,6 +85,20 @@ def save_xpath(element, xpath, fallback=''):
         return fallback
 
 
+def solr_escape(value):
+    """Escape all characters with a special meaning in Solr queries."""
+
+    return re.sub(r'([+\-&|!(){}\[\]^"~*?:\\/ ])', r'\\\1', value)
+
+
+def solr_any(field, values):
+    """Build a Solr query matching any of the given values in a field."""
+
+    escape = lambda v: v.replace('\\', '\\\\').replace('"', '\\"')
+    terms = ' OR '.join('"%s"' % escape(val) for val in values)
+    return '%s:(%s)' % (field, terms)
+
+
 def url_encode(data):
     """Safely encode a dictionary to a URL compatible string."""
 